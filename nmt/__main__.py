@@ -1,7 +1,9 @@
 from __future__ import print_function
 from __future__ import division
 
-from nmt.train import Trainer
+import torch.multiprocessing
+
+from nmt.train import train_process
 from nmt.translate import Translator
 from nmt.extractor import Extractor
 
@@ -9,9 +11,10 @@ from nmt.args import parser
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    if args.mode == 'train':
-        trainer = Trainer(args)
-        trainer.train()
+    if args.mode == 'train' and args.num_procs > 1:
+        torch.multiprocessing.spawn(train_process, args=(args,), nprocs=args.num_procs)
+    elif args.mode == 'train':
+        train_process(0, args)
     elif args.mode == 'translate':
         translator = Translator(args)
     elif args.mode == 'extract':
@@ -34,6 +34,16 @@ NO_LENGTH_MODEL = 0
 LINEAR_LENGTH_MODEL = 1
 GNMT_LENGTH_MODEL = 2
 
+ATT_MATH = 0
+ATT_FUSED = 1
+
+BEAM_DECODE = 0
+GREEDY_DECODE = 1
+SAMPLE_DECODE = 2
+
+SHUFFLE_INDEX = 0
+SHUFFLE_REWRITE = 1
+
 SEED = 151
 
 # Default number of lines to read in,
@@ -10,15 +10,26 @@ parser.add_argument('--num-preload', type=int, default=ac.DEFAULT_NUM_PRELOAD,
                     help="""
                          Number of samples prefetched to memory.
                          Small is slower but too big might make data
-                         less randomized.""")
+                         less randomized (unless bucket_batches is set,
+                         in which case batches are planned over the whole corpus).""")
 parser.add_argument('--input-file', type=str, 
                     help='Input file if mode == translate')
 parser.add_argument('--model-file', type=str, required=False,
                     help='Path to saved checkpoint if mode == translate')
+parser.add_argument('--decode-mode', choices=['beam', 'greedy', 'sample'],
+                    help='How to choose translations if mode == translate (overrides decode_mode in the config)')
 parser.add_argument('--var-list', nargs='+',
                     help='List of model vars to extracted')
 parser.add_argument('--save-to', required='--var-list' in sys.argv,
                     help='Extract vars to this directory.')
+parser.add_argument('--num-procs', type=int, default=1,
+                    help="""
+                         Number of data-parallel training processes to start on this machine
+                         (DistributedDataParallel over gloo). For several machines, launch with torchrun instead.""")
+parser.add_argument('--dist-timeout', type=float, default=180,
+                    help="""
+                         Minutes a training process waits for the others at a synchronization point
+                         (e.g. while the first one preprocesses the corpus or runs validation) before failing.""")
 parser.add_argument('--config-overrides', type=str,
                     help='Dict of k-v pairs to override config with')
 
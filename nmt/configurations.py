@@ -100,16 +100,47 @@ base_config = Config(
     # if False, dropout->add->layer-norm (as in original paper)
     norm_in = True,
 
+    # How attention is computed:
+    # - ac.ATT_FUSED: with torch's scaled_dot_product_attention, which picks a fused, memory-efficient kernel
+    #   (when the installed torch lacks it, falls back to ac.ATT_MATH)
+    # - ac.ATT_MATH: with explicit matmuls and softmax, materializing the attention weights
+    att_backend = ac.ATT_FUSED,
+    # Run the model's forward passes (training, validation and decoding) under torch.autocast in bfloat16.
+    # The parameters, the output softmax/loss and the tree positional embeddings stay in fp32
+    mixed_precision = False,
+
     ### Dropout/smoothing options
 
     dropout = 0.3,
     word_dropout = 0.1,
     label_smoothing = 0.1,
+    # Compute the loss over this many (non-pad) target tokens at a time, recomputing their log-probs
+    # in the backward pass, so the full [tokens, vocab] log-probs are never kept (0 computes it all at once)
+    loss_chunk_size = 2048,
 
     ### Training options
 
     batch_sort_src = True,
     batch_size = 4096,
+    # Sum the gradients of this many batches before each optimizer step,
+    # for the effective batch size of accum_steps * batch_size without its memory
+    accum_steps = 1,
+    # Batch sentences of similar length from the whole training corpus (shuffling the batches),
+    # rather than only within each window of --num-preload sentences
+    bucket_batches = True,
+    # How to shuffle the training corpus each epoch:
+    # - ac.SHUFFLE_INDEX: read the sentences in a random order, leaving the corpus files untouched
+    #   (so they can be shared read-only between jobs)
+    # - ac.SHUFFLE_REWRITE: rewrite the corpus files in a random order, then read them sequentially
+    shuffle_mode = ac.SHUFFLE_INDEX,
+    # Number of worker processes preparing batches ahead of the training loop (0 prepares them inline),
+    # and how many preload windows each worker may have ready before waiting
+    num_data_workers = 0,
+    data_prefetch = 2,
+    # Copy batches to the gpu asynchronously from page-locked memory
+    pin_memory = False,
+    # Number of batches converted to tensors in a background thread ahead of the training step (0 converts them inline)
+    tensor_prefetch = 2,
     weight_init_type = ac.XAVIER_NORMAL,
     normalize_loss = ac.LOSS_TOK,
 
@@ -159,12 +190,35 @@ base_config = Config(
     # For gnmt, this is the exponent; for linear, this is the strength of the reward
     length_alpha = 0.6,
 
+    # Store each source sentence's relation mask (if its struct has one) with the preprocessed ids,
+    # instead of recomputing it for every batch
+    cache_enc_masks = True,
+
     # Filter out sentences longer than this (minus one for bos/eos)
     max_src_length = 1000,
     max_trg_length = 1000,
 
     ### Decoding options
+    # How to choose translations:
+    # - ac.BEAM_DECODE: beam search, keeping beam_size hypotheses per sentence
+    # - ac.GREEDY_DECODE: the most probable word at each step
+    # - ac.SAMPLE_DECODE: a word sampled at each step from the model's distribution, at sample_temperature
+    #   (0 is the same as ac.GREEDY_DECODE),
+    #   restricted to the sample_top_k most probable words (if not 0)
+    #   and to the fewest most probable words with total probability at least sample_top_p (if below 1)
+    decode_mode = ac.BEAM_DECODE,
     beam_size = 4,
+    # Take finished hypotheses out of the beam, and stop decoding each sentence
+    # once no live hypothesis can outscore its best finished one
+    beam_prune = False,
+    sample_top_k = 0,
+    sample_top_p = 1.0,
+    sample_temperature = 1.0,
+    # Restrict the output layer when decoding each batch to the shortlist_size target words
+    # co-occurring most in the training data with each of its source words (0 uses the full vocab),
+    # plus the shortlist_frequent most frequent target words
+    shortlist_size = 0,
+    shortlist_frequent = 100,
 
     # Warn if an adaptation introduces a new option (as it may be a typo)
     warn_new_option = True,
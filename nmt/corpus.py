@@ -0,0 +1,181 @@
+import os
+import numpy
+
+import nmt.utils as ut
+
+
+# Number of sentences gathered in memory at a time by Corpus.shuffle
+SHUFFLE_CHUNK_SIZE = 100000
+
+# Offsets fields, and the fields they index into
+SEGMENTS = {
+    'src_offsets': ['src_toks', 'src_topology'],
+    'trg_offsets': ['trg_toks'],
+    'src_mask_offsets': ['src_mask_values', 'src_mask_lengths'],
+}
+
+
+class Corpus(object):
+    """
+    Binary, memory-mapped store of preprocessed sentence pairs.
+    Each field is a flat numpy array saved raw to f'{prefix}.{field}'.
+    Sentence i has source ids src_toks[src_offsets[i]:src_offsets[i+1]]
+    with shape codes src_topology[src_offsets[i]:src_offsets[i+1]] (see Struct.topology),
+    and target ids trg_toks[trg_offsets[i]:trg_offsets[i+1]].
+    If the source struct has a relation_mask, it is stored run-length encoded by row,
+    as runs src_mask_values/src_mask_lengths[src_mask_offsets[i]:src_mask_offsets[i+1]].
+    """
+
+    FIELDS = {
+        'src_toks': numpy.int32,
+        'src_topology': numpy.uint8,
+        'src_offsets': numpy.int64,
+        'trg_toks': numpy.int32,
+        'trg_offsets': numpy.int64,
+        'src_mask_values': numpy.uint16,
+        'src_mask_lengths': numpy.uint16,
+        'src_mask_offsets': numpy.int64,
+    }
+
+    def __init__(self, prefix):
+        super(Corpus, self).__init__()
+        self.prefix = prefix
+        self.open()
+
+    def get_path(self, field):
+        return f'{self.prefix}.{field}'
+
+    def open(self):
+        for field, dtype in self.FIELDS.items():
+            fp = self.get_path(field)
+            if os.path.getsize(fp):
+                setattr(self, field, numpy.memmap(fp, dtype=dtype, mode='r'))
+            else:
+                setattr(self, field, numpy.zeros([0], dtype=dtype)) # can't mmap an empty file
+
+    def close(self):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    def src_lengths(self):
+        return numpy.diff(self.src_offsets)
+
+    def trg_lengths(self):
+        return numpy.diff(self.trg_offsets)
+
+    def read(self, idxs):
+        """
+        Returns lists of (src ids, src topology, trg ids, src relation mask) arrays for sentences idxs,
+        which may be in any order (e.g. a window of a random permutation),
+        where the masks are None if they were not stored
+        """
+        idxs = numpy.asarray(idxs, dtype=numpy.int64)
+        src_offsets, src_idxs = reorder_offsets(self.src_offsets, idxs)
+        trg_offsets, trg_idxs = reorder_offsets(self.trg_offsets, idxs)
+        src_toks = numpy.split(self.src_toks[src_idxs], src_offsets[1:-1])
+        src_topology = numpy.split(self.src_topology[src_idxs], src_offsets[1:-1])
+        trg_toks = numpy.split(self.trg_toks[trg_idxs], trg_offsets[1:-1])
+
+        _, mask_idxs = reorder_offsets(self.src_mask_offsets, idxs)
+        if not len(mask_idxs):
+            src_masks = [None] * len(src_toks)
+        else:
+            sizes = numpy.diff(src_offsets)
+            dense = numpy.repeat(self.src_mask_values[mask_idxs], self.src_mask_lengths[mask_idxs])
+            src_masks = [m.reshape(size, size) for m, size in zip(numpy.split(dense, numpy.cumsum(sizes ** 2)[:-1]), sizes)]
+        return src_toks, src_topology, trg_toks, src_masks
+
+    def shuffle(self, chunk_size=SHUFFLE_CHUNK_SIZE):
+        """
+        Rewrites the corpus with its sentences in random order.
+        Only the permutation is held in memory in full; sentences are gathered from the memmaps
+        and streamed to temporary files chunk_size sentences at a time, which then replace the originals.
+        """
+        order = ut.shuffle_indices(len(self))
+        files = {field: open(self.get_path(field) + '.tmp', 'wb') for field in self.FIELDS}
+        totals = dict.fromkeys(SEGMENTS, 0)
+        for offsets_field in SEGMENTS:
+            numpy.zeros([1], dtype=numpy.int64).tofile(files[offsets_field])
+        for start in range(0, len(order), chunk_size):
+            chunk = order[start:start + chunk_size]
+            for offsets_field, fields in SEGMENTS.items():
+                new_offsets, idxs = reorder_offsets(getattr(self, offsets_field), chunk)
+                (new_offsets[1:] + totals[offsets_field]).tofile(files[offsets_field])
+                totals[offsets_field] += int(new_offsets[-1])
+                for field in fields:
+                    getattr(self, field)[idxs].astype(self.FIELDS[field], copy=False).tofile(files[field])
+        for f in files.values():
+            f.close()
+        self.close()
+        for field in self.FIELDS:
+            os.replace(self.get_path(field) + '.tmp', self.get_path(field))
+        self.open()
+
+
+class CorpusWriter(object):
+    "Streams sentence pairs to the files read by Corpus"
+
+    def __init__(self, prefix):
+        super(CorpusWriter, self).__init__()
+        self.prefix = prefix
+        self.num_lines = 0
+        self.src_offset = 0
+        self.trg_offset = 0
+        self.mask_offset = 0
+
+    def __enter__(self):
+        self.files = {field: open(f'{self.prefix}.{field}', 'wb') for field in Corpus.FIELDS}
+        self.write_field('src_offsets', [0])
+        self.write_field('trg_offsets', [0])
+        self.write_field('src_mask_offsets', [0])
+        return self
+
+    def __exit__(self, *exc):
+        for f in self.files.values():
+            f.close()
+
+    def write_field(self, field, values):
+        self.files[field].write(numpy.asarray(values, dtype=Corpus.FIELDS[field]).tobytes())
+
+    def write(self, src_ids, src_topology, trg_ids, src_mask=None):
+        if src_mask is not None:
+            values, lengths = encode_rows(src_mask)
+            self.mask_offset += len(values)
+            self.write_field('src_mask_values', values)
+            self.write_field('src_mask_lengths', lengths)
+        self.write_field('src_mask_offsets', [self.mask_offset])
+        self.num_lines += 1
+        self.src_offset += len(src_ids)
+        self.trg_offset += len(trg_ids)
+        self.write_field('src_toks', src_ids)
+        self.write_field('src_topology', src_topology)
+        self.write_field('src_offsets', [self.src_offset])
+        self.write_field('trg_toks', trg_ids)
+        self.write_field('trg_offsets', [self.trg_offset])
+
+
+def encode_rows(matrix):
+    "Run-length encodes each row of a square matrix, returning (values, lengths) of the runs"
+    size = len(matrix)
+    flat = numpy.asarray(matrix).reshape(-1)
+    starts = numpy.ones(len(flat), dtype=bool)
+    starts[1:] = flat[1:] != flat[:-1]
+    starts[::size] = True # runs never cross rows, so lengths fit in uint16
+    starts = numpy.flatnonzero(starts)
+    return flat[starts], numpy.diff(numpy.append(starts, len(flat)))
+
+
+def reorder_offsets(offsets, order):
+    """
+    Given offsets of contiguous segments and a new order for those segments,
+    returns the new offsets and the indices that gather the reordered data
+    """
+    starts = numpy.asarray(offsets[order])
+    lengths = numpy.asarray(offsets[order + 1]) - starts
+    new_offsets = numpy.zeros([len(lengths) + 1], dtype=numpy.int64)
+    numpy.cumsum(lengths, out=new_offsets[1:])
+    idxs = numpy.arange(new_offsets[-1], dtype=numpy.int64) + numpy.repeat(starts - new_offsets[:-1], lengths)
+    return new_offsets, idxs
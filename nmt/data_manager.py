@@ -6,14 +6,21 @@ import numpy
 import torch
 import shutil
 import io
+import importlib
+import multiprocessing
+import threading
+import traceback
+from queue import Queue, Full, Empty
 
 import nmt.utils as ut
 import nmt.all_constants as ac
+from nmt.corpus import Corpus, CorpusWriter
 
 class DataManager(object):
 
     def __init__(self, config, init_vocab=True):
         super(DataManager, self).__init__()
+        self.config = config
         self.logger = ut.get_logger(config['log_file'])
         self.src_lang = config['src_lang']
         self.trg_lang = config['trg_lang']
@@ -24,11 +31,23 @@ class DataManager(object):
         self.share_vocab = config['share_vocab']
         self.word_dropout = config['word_dropout']
         self.batch_sort_src = config['batch_sort_src']
+        self.shuffle_mode = config['shuffle_mode']
+        self.bucket_batches = config['bucket_batches']
+        self.num_data_workers = config['num_data_workers']
+        self.pin_memory = config['pin_memory']
+        self.data_prefetch = config['data_prefetch']
+        self.tensor_prefetch = config['tensor_prefetch']
+        self.accum_steps = config['accum_steps'] # number of batches the trainer holds at once
         self.max_src_length = config['max_src_length']
         self.max_trg_length = config['max_trg_length']
         self.parse_struct = config['struct'].parse
+        self.unflatten_struct = config['struct'].unflatten
+        self.unflatten_structs = getattr(config['struct'], 'unflatten_batch', None)
+        self.cache_enc_masks = config['cache_enc_masks'] and hasattr(config['struct'], 'get_enc_mask')
+        self.shortlist_size = config['shortlist_size']
         self.training_tok_counts = (-1, -1)
         self.vocab_masks = {}
+        self.shortlist_table = None
 
         self.vocab_sizes = {
             self.src_lang: config['src_vocab_size'],
@@ -40,7 +59,7 @@ class DataManager(object):
             self.setup()
         else:
             self.data_files = None
-            self.ids_files = None
+            self.corpus_files = None
 
     ############## Vocab Functions ##############
 
@@ -50,15 +69,20 @@ class DataManager(object):
                    for lang in [self.src_lang, self.trg_lang]}
             for mode in [ac.TRAINING, ac.VALIDATING, ac.TESTING]
         }
-        self.ids_files = {
-            mode: os.path.join(self.save_to, f'{ut.get_mode_name(mode)}.ids')
+        self.corpus_files = {
+            mode: os.path.join(self.save_to, ut.get_mode_name(mode))
             for mode in [ac.TRAINING, ac.VALIDATING, ac.TESTING]
         }
         self.create_vocabs()
-        self.parallel_data_to_token_ids(mode=ac.TRAINING)
-        self.parallel_data_to_token_ids(mode=ac.VALIDATING)
-        if os.path.exists(self.data_files[ac.TESTING][self.src_lang]) and os.path.exists(self.data_files[ac.TESTING][self.trg_lang]):
-            self.parallel_data_to_token_ids(mode=ac.TESTING)
+        # with several training processes, the first one writes the corpus files the others read
+        if ut.get_rank() == 0:
+            self.parallel_data_to_token_ids(mode=ac.TRAINING)
+            self.parallel_data_to_token_ids(mode=ac.VALIDATING)
+            if os.path.exists(self.data_files[ac.TESTING][self.src_lang]) and os.path.exists(self.data_files[ac.TESTING][self.trg_lang]):
+                self.parallel_data_to_token_ids(mode=ac.TESTING)
+        ut.barrier()
+        if self.shortlist_size:
+            self.create_shortlist_table()
 
     def create_vocabs(self):
         src_file = self.data_files[ac.TRAINING][self.src_lang]
@@ -128,61 +152,133 @@ class DataManager(object):
             return mask
         
 
+    def create_shortlist_table(self, chunk_size=10000):
+        """
+        Sets self.shortlist_table [src vocab, shortlist_size] to the target words that co-occur most often
+        with each source word in the preprocessed training corpus (padded with PAD_ID), as candidate outputs for decoding.
+        With several training processes, the first one scans the corpus and sends the table to the others.
+        """
+        table = self.count_shortlist_table(chunk_size) if ut.get_rank() == 0 else None
+        self.shortlist_table = torch.from_numpy(ut.broadcast_object(table)).to(ut.get_device())
+
+    def count_shortlist_table(self, chunk_size):
+        """
+        Returns the shortlist table (see create_shortlist_table) as a numpy array.
+        Co-occurring (non-special) token pairs are counted chunk_size sentences at a time,
+        and the chunks' counts are merged once at the end.
+        """
+        self.logger.info('Computing output shortlists from training data')
+        corpus = Corpus(self.corpus_files[ac.TRAINING])
+        src_vocab_size = len(self.src_ivocab)
+        trg_vocab_size = len(self.trg_ivocab)
+        chunk_codes = [numpy.zeros([0], dtype=numpy.int64)]
+        chunk_counts = [numpy.zeros([0], dtype=numpy.int64)]
+        for start in range(0, len(corpus), chunk_size):
+            src_inputs, _, trg_inputs, _ = corpus.read(numpy.arange(start, min(start + chunk_size, len(corpus))))
+            pairs = [numpy.add.outer(src_toks[src_toks >= len(ac._START_VOCAB)].astype(numpy.int64) * trg_vocab_size,
+                                     trg_toks[trg_toks >= len(ac._START_VOCAB)]).reshape(-1)
+                     for src_toks, trg_toks in zip(src_inputs, trg_inputs)]
+            new_codes, new_counts = numpy.unique(numpy.concatenate(pairs), return_counts=True)
+            chunk_codes.append(new_codes)
+            chunk_counts.append(new_counts)
+        codes, inverse = numpy.unique(numpy.concatenate(chunk_codes), return_inverse=True)
+        counts = numpy.bincount(inverse, numpy.concatenate(chunk_counts), minlength=len(codes)).astype(numpy.int64)
+        del chunk_codes, chunk_counts, inverse
+
+        src_ids, trg_ids = numpy.divmod(codes, trg_vocab_size)
+        order = numpy.lexsort((-counts, src_ids)) # by source word, then most frequent first
+        src_ids, trg_ids = src_ids[order], trg_ids[order]
+        ranks = numpy.arange(len(src_ids)) - numpy.searchsorted(src_ids, src_ids)
+        top = ranks < self.shortlist_size
+        table = numpy.full([src_vocab_size, self.shortlist_size], ac.PAD_ID, dtype=numpy.int64)
+        table[src_ids[top], ranks[top]] = trg_ids[top]
+        return table
+
     def parallel_data_to_token_ids(self, mode=ac.TRAINING):
         src_file = self.data_files[mode][self.src_lang]
         trg_file = self.data_files[mode][self.trg_lang]
-        joint_file = self.ids_files[mode]
+        corpus_file = self.corpus_files[mode]
 
         self.logger.info(f'Converting {ut.get_mode_name(mode)} data to ids')
-        open(joint_file, 'w').close()
-        num_lines = 0
-        src_tok_count = 0
-        trg_tok_count = 0
         with open(src_file, 'r') as src_f, \
              open(trg_file, 'r') as trg_f, \
-             open(joint_file, 'w') as tokens_f:
+             CorpusWriter(corpus_file) as corpus_w:
 
             for src_line, trg_line in zip(src_f, trg_f):
                 src_prsd = self.parse_line(src_line, is_src=True, to_ids=True)
                 trg_ids = self.parse_line(trg_line, is_src=False, to_ids=True)
 
                 if 0 < src_prsd.size() and 1 < len(trg_ids):
-                    num_lines += 1
-                    if num_lines % 10000 == 0:
-                        self.logger.info(f'  converting line {num_lines}')
-                    src_ids = src_prsd.flatten()
-                    data = str(src_prsd) + '|||' + ' '.join(map(str, trg_ids)) + '\n'
-                    tokens_f.write(data)
+                    src_mask = src_prsd.relation_mask() if self.cache_enc_masks else None
+                    corpus_w.write(src_prsd.flatten(), src_prsd.topology(), trg_ids, src_mask)
+                    if corpus_w.num_lines % 10000 == 0:
+                        self.logger.info(f'  converting line {corpus_w.num_lines}')
 
 
 
     ############## Batch Functions ##############
 
-    def replace_with_unk(self, data):
-        drop_mask = numpy.random.choice([True, False], data.shape, p=[self.word_dropout, 1.0 - self.word_dropout])
+    def replace_with_unk(self, data, rng=numpy.random):
+        drop_mask = rng.choice([True, False], data.shape, p=[self.word_dropout, 1.0 - self.word_dropout])
         drop_mask = numpy.logical_and(drop_mask, data != ac.PAD_ID)
         data[drop_mask] = ac.UNK_ID
 
     def _prepare_one_batch(self, b_src_input, b_src_seq_length, b_src_structs, b_trg_input, b_trg_seq_length, with_trg=True):
         batch_size = len(b_src_input)
-        max_src_length = max(b_src_seq_length)
-        max_trg_length = max(b_trg_seq_length) if with_trg else 0
-
-        src_input_batch = numpy.zeros([batch_size, max_src_length], dtype=numpy.int32)
-        trg_input_batch = numpy.zeros([batch_size, max_trg_length], dtype=numpy.int32)
-        trg_target_batch = numpy.zeros([batch_size, max_trg_length], dtype=numpy.int32)
-
-        for i in range(batch_size):
-            src_input_batch[i] = list(b_src_input[i]) + (max_src_length - b_src_seq_length[i]) * [ac.PAD_ID]
-            if with_trg:
-                trg_input_batch[i] = list(b_trg_input[i]) + (max_trg_length - b_trg_seq_length[i]) * [ac.PAD_ID]
-                trg_target_batch[i] = list(b_trg_input[i][1:]) + [ac.EOS_ID] + (max_trg_length - b_trg_seq_length[i]) * [ac.PAD_ID]
-            else:
-                trg_input_batch[i] = []
-                trg_target_batch[i] = []
+        src_input_batch = ut.pad_sequences(numpy.concatenate(b_src_input), b_src_seq_length, ac.PAD_ID)
+
+        if with_trg:
+            # targets are the inputs shifted left by one, ending with eos
+            trg_input_flat = numpy.concatenate(b_trg_input)
+            trg_target_flat = numpy.append(trg_input_flat[1:], ac.EOS_ID)
+            trg_target_flat[numpy.cumsum(b_trg_seq_length) - 1] = ac.EOS_ID
+            trg_input_batch = ut.pad_sequences(trg_input_flat, b_trg_seq_length, ac.PAD_ID)
+            trg_target_batch = ut.pad_sequences(trg_target_flat, b_trg_seq_length, ac.PAD_ID)
+        else:
+            trg_input_batch = numpy.zeros([batch_size, 0], dtype=numpy.int32)
+            trg_target_batch = numpy.zeros([batch_size, 0], dtype=numpy.int32)
 
         return src_input_batch, b_src_structs, trg_input_batch, trg_target_batch
 
+    def make_batch(self, b_src_input, b_src_seq_length, b_src_structs, b_trg_input, b_trg_seq_length, is_training=True, with_trg=True, rng=numpy.random):
+        "Pads one batch of sentences, applying word dropout (drawn from rng) when training"
+        batch_values = self._prepare_one_batch(b_src_input, b_src_seq_length, b_src_structs, b_trg_input, b_trg_seq_length, with_trg=with_trg)
+        src_input_batch, src_structs_batch, trg_input_batch, trg_target_batch = batch_values
+
+        if is_training:
+            self.replace_with_unk(src_input_batch, rng)
+            if with_trg: self.replace_with_unk(trg_input_batch, rng)
+
+        # Make sure only the structure of src is used
+        # (some toks may have been replaced with UNK)
+        src_structs_batch = [struct.forget() for struct in src_structs_batch]
+        return src_input_batch, src_structs_batch, trg_input_batch, trg_target_batch
+
+    def split_batches(self, src_seq_lengths, trg_seq_lengths=None):
+        """
+        Splits sentences with the given lengths (sorted by length) into consecutive batches
+        of at most self.batch_size tokens, including padding, returning their (start, end) indices.
+        Without trg_seq_lengths, target lengths are estimated from the training token counts.
+        """
+        est_src_trg_ratio = self.training_tok_counts[0] / sum(self.training_tok_counts)
+        with_trg = trg_seq_lengths is not None
+
+        s_idx = 0
+        while s_idx < len(src_seq_lengths):
+            e_idx = s_idx + 1
+            max_src_in_batch = src_seq_lengths[s_idx]
+            max_trg_in_batch = with_trg and trg_seq_lengths[s_idx]
+            while e_idx < len(src_seq_lengths):
+                max_src_in_batch = max(max_src_in_batch, src_seq_lengths[e_idx])
+                if with_trg: max_trg_in_batch = max(max_trg_in_batch, trg_seq_lengths[e_idx])
+                else: max_trg_in_batch = round(max_src_in_batch * est_src_trg_ratio)
+                count = (e_idx - s_idx + 1) * max(max_src_in_batch, max_trg_in_batch)
+                #count = (e_idx - s_idx + 1) * (max_src_in_batch + max_trg_in_batch)
+                if count > self.batch_size: break
+                else: e_idx += 1
+            yield s_idx, e_idx
+            s_idx = e_idx
+
     def prepare_batches(self, src_inputs, src_seq_lengths, src_structs, trg_inputs, trg_seq_lengths, is_training=True, with_trg=True):
 
         # Sorting by src lengths
@@ -200,41 +296,18 @@ class DataManager(object):
         trg_target_batches = []
         idxs_batches = []
 
-        est_src_trg_ratio = self.training_tok_counts[0] / sum(self.training_tok_counts)
-
-        s_idx = 0
-        while s_idx < len(src_inputs):
-            e_idx = s_idx + 1
-            max_src_in_batch = src_seq_lengths[s_idx]
-            max_trg_in_batch = with_trg and trg_seq_lengths[s_idx]
-            while e_idx < len(src_inputs):
-                max_src_in_batch = max(max_src_in_batch, src_seq_lengths[e_idx])
-                if with_trg: max_trg_in_batch = max(max_trg_in_batch, trg_seq_lengths[e_idx])
-                else: max_trg_in_batch = round(max_src_in_batch * est_src_trg_ratio)
-                count = (e_idx - s_idx + 1) * max(max_src_in_batch, max_trg_in_batch)
-                #count = (e_idx - s_idx + 1) * (max_src_in_batch + max_trg_in_batch)
-                if count > self.batch_size: break
-                else: e_idx += 1
-
+        for s_idx, e_idx in self.split_batches(src_seq_lengths, trg_seq_lengths if with_trg else None):
             idxs_batch = sorted_idxs[s_idx:e_idx]
-            batch_values = self._prepare_one_batch(
+            batch_values = self.make_batch(
                 src_inputs[s_idx:e_idx],
                 src_seq_lengths[s_idx:e_idx],
                 src_structs[s_idx:e_idx],
                 trg_inputs[s_idx:e_idx],
                 trg_seq_lengths[s_idx:e_idx],
+                is_training=is_training,
                 with_trg=with_trg)
             src_input_batch, src_structs_batch, trg_input_batch, trg_target_batch = batch_values
 
-            if is_training:
-                self.replace_with_unk(src_input_batch)
-                if with_trg: self.replace_with_unk(trg_input_batch)
-
-            # Make sure only the structure of src is used
-            # (some toks may have been replaced with UNK)
-            src_structs_batch = [struct.forget() for struct in src_structs_batch]
-            
-            s_idx = e_idx
             idxs_batches.append(idxs_batch)
             src_input_batches.append(src_input_batch)
             src_structs_batches.append(src_structs_batch)
@@ -285,32 +358,227 @@ class DataManager(object):
 
         return src_inputs, src_seq_lengths, src_structs, trg_inputs, trg_seq_lengths
 
-    def read_batches(self, read_handler, is_training=True, num_preload=ac.DEFAULT_NUM_PRELOAD, to_ids=False, with_trg=True):
+    def process_corpus_records(self, corpus, idxs):
+        src_inputs, src_topologies, trg_inputs, src_masks = corpus.read(idxs)
+        if self.unflatten_structs is not None:
+            src_structs = self.unflatten_structs(src_inputs, src_topologies)
+        else:
+            src_structs = [self.unflatten_struct(toks, topology) for toks, topology in zip(src_inputs, src_topologies)]
+        for struct, mask in zip(src_structs, src_masks):
+            if mask is not None: struct.set_relation_mask(mask)
+        src_seq_lengths = numpy.array([len(toks) for toks in src_inputs])
+        trg_seq_lengths = numpy.array([len(toks) for toks in trg_inputs])
+        return ut.object_array(src_inputs), src_seq_lengths, ut.object_array(src_structs), ut.object_array(trg_inputs), trg_seq_lengths
+
+    def tensorize_batches(self, batches):
+        """
+        Yields each batch in batches (an iterator of untensorized batches, as zipped from prepare_batches)
+        with its token ids converted to int64 tensors on the device.
+        With self.tensor_prefetch > 0, the conversion runs in a background thread up to tensor_prefetch batches
+        ahead, into a ring of tensor_prefetch + accum_steps + 1 reusable buffers. The tensors of a batch are then
+        only valid until tensor_prefetch + accum_steps more batches have been taken (on cpu, they are the buffers themselves).
+        """
         device = ut.get_device()
+        pin_memory = self.pin_memory and device.type == 'cuda'
+        if self.tensor_prefetch > 0:
+            yield from self.tensorize_batches_async(batches, device, pin_memory)
+            return
+
+        def tensorize(x):
+            x = torch.from_numpy(x).type(torch.long)
+            return x.pin_memory().to(device, non_blocking=True) if pin_memory else x.to(device)
+        for original_idxs, src_inputs, src_structs, trg_inputs, trg_target in batches:
+            yield (original_idxs,
+                   tensorize(src_inputs),
+                   src_structs,
+                   tensorize(trg_inputs),
+                   tensorize(trg_target))
+
+    def tensorize_batches_async(self, batches, device, pin_memory):
+        "Background-thread version of tensorize_batches"
+        slots = [TensorSlot(device, pin_memory) for _ in range(self.tensor_prefetch + self.accum_steps + 1)]
+        ready = Queue(self.tensor_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=tensorize_in_background, args=(batches, slots, ready, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = ready.get()
+                if batch is None: break
+                if isinstance(batch, Exception): raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def prepare_text_batches(self, read_handler, is_training=True, num_preload=ac.DEFAULT_NUM_PRELOAD, to_ids=False, with_trg=True):
+        "Yields the untensorized batches of the lines in read_handler, num_preload lines at a time"
         while True:
             next_n_lines = list(itertools.islice(read_handler, num_preload))
             if not next_n_lines: break
             src_inputs, src_seq_lengths, src_structs, trg_inputs, trg_seq_lengths = self.process_n_batches(next_n_lines, to_ids=to_ids, with_trg=with_trg)
             batches = self.prepare_batches(src_inputs, src_seq_lengths, src_structs, trg_inputs, trg_seq_lengths, is_training=is_training, with_trg=with_trg)
-            for original_idxs, src_inputs, src_structs, trg_inputs, trg_target in zip(*batches):
-                yield (original_idxs,
-                       torch.from_numpy(src_inputs).type(torch.long).to(device),
-                       src_structs,
-                       torch.from_numpy(trg_inputs).type(torch.long).to(device),
-                       torch.from_numpy(trg_target).type(torch.long).to(device))
+            yield from zip(*batches)
+
+    def read_batches(self, read_handler, is_training=True, num_preload=ac.DEFAULT_NUM_PRELOAD, to_ids=False, with_trg=True):
+        yield from self.tensorize_batches(self.prepare_text_batches(read_handler, is_training, num_preload, to_ids, with_trg))
+
+    def plan_batches(self, corpus, order, is_training=True, num_preload=ac.DEFAULT_NUM_PRELOAD):
+        """
+        Groups the sentence indices in order into batches, using only the lengths stored in corpus,
+        and returns them as a list of windows (lists of batches) to be read together.
+        With self.bucket_batches, the whole of order is sorted by length (ties stay in the order given,
+        so bucket membership is random when order is) before splitting into batches,
+        and the batches are then shuffled across buckets and grouped into windows of about num_preload sentences.
+        Otherwise, each window of num_preload sentences in order is sorted and batched on its own.
+        """
+        src_lengths = corpus.src_lengths()
+        trg_lengths = corpus.trg_lengths()
+        sort_lengths = src_lengths if self.batch_sort_src else trg_lengths
+        window_size = len(order) if self.bucket_batches else num_preload
+
+        windows = []
+        for start in range(0, len(order), window_size):
+            idxs = order[start:start + window_size]
+            # Sorting by src lengths
+            # https://www.aclweb.org/anthology/W17-3203
+            idxs = idxs[numpy.argsort(sort_lengths[idxs], kind='stable')]
+            batches = [idxs[s_idx:e_idx] for s_idx, e_idx in self.split_batches(src_lengths[idxs].tolist(), trg_lengths[idxs].tolist())]
+            if is_training:
+                batches = ut.reorder(batches, ut.shuffle_indices(len(batches)))
+            windows.append(batches)
+
+        if self.bucket_batches and windows:
+            batches, windows = windows[0], []
+            for batch in batches:
+                if not windows or sum(map(len, windows[-1])) >= num_preload:
+                    windows.append([])
+                windows[-1].append(batch)
+        return windows
+
+    def log_batch_stats(self, corpus, windows):
+        src_lengths = corpus.src_lengths()
+        trg_lengths = corpus.trg_lengths()
+        batches = [batch for window in windows for batch in window]
+        num_toks = sum(int(src_lengths[batch].sum() + trg_lengths[batch].sum()) for batch in batches)
+        num_padded = sum(len(batch) * int(src_lengths[batch].max() + trg_lengths[batch].max()) for batch in batches)
+        self.logger.info(f'{len(batches):,} batches, {num_toks / max(len(batches), 1):,.0f} tokens per batch, '
+                         f'{1 - num_toks / max(num_padded, 1):.1%} padding')
+
+    def shard_windows(self, windows):
+        """
+        With several training processes, returns this process's share of the first process's windows:
+        every world_size-th batch, truncated so that all the processes take the same number of batches.
+        """
+        rank, world_size = ut.get_rank(), ut.get_world_size()
+        if world_size == 1:
+            return windows
+        windows = ut.broadcast_object(windows)
+        num_batches = sum(map(len, windows)) // world_size * world_size
+        sharded, start = [], 0
+        for batches in windows:
+            share = [batch for i, batch in enumerate(batches, start) if i < num_batches and i % world_size == rank]
+            start += len(batches)
+            if share:
+                sharded.append(share)
+        return sharded
+
+    def prepare_window(self, corpus, batches, is_training=True, rng=numpy.random):
+        "Reads the sentences of a window of batches from corpus and prepares the batches, in the same format as prepare_batches"
+        src_inputs, src_seq_lengths, src_structs, trg_inputs, trg_seq_lengths = self.process_corpus_records(corpus, numpy.concatenate(batches))
+        prepared = [], [], [], [], []
+        start = 0
+        for batch in batches:
+            end = start + len(batch)
+            batch_values = self.make_batch(src_inputs[start:end], src_seq_lengths[start:end], src_structs[start:end],
+                                           trg_inputs[start:end], trg_seq_lengths[start:end], is_training=is_training, rng=rng)
+            for xs, x in zip(prepared, (batch,) + batch_values):
+                xs.append(x)
+            start = end
+        return prepared
+
+    def read_corpus_batches(self, corpus, windows, is_training=True, seed=0):
+        """
+        Yields the untensorized batches of corpus planned in windows (see plan_batches).
+        Window i draws its word dropout from its own numpy.random.RandomState(seed + i),
+        so the batches don't depend on which thread or process prepares them.
+        """
+        for i, batches in enumerate(windows):
+            yield from zip(*self.prepare_window(corpus, batches, is_training, numpy.random.RandomState(seed + i)))
+
+    def read_corpus_batches_async(self, corpus, windows, is_training=True, seed=0):
+        """
+        Same as read_corpus_batches, but with windows prepared by self.num_data_workers processes.
+        Worker i handles windows i, i + num_workers, ..., which are consumed in order.
+        Windows are seeded as in read_corpus_batches, so the batches are the same for any number of workers.
+        The workers are started right away, rather than when the returned generator is first iterated.
+        They are not forked from this process, which may be running other threads (e.g. tensorize_batches_async)
+        that hold locks the children would inherit held, but from a forkserver (or spawned where there is none),
+        so they get the config and vocab passed explicitly and rebuild their own DataManager.
+        """
+        num_workers = self.num_data_workers
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['nmt.data_manager']) # import torch once in the server, not in each worker
+        else:
+            context = multiprocessing.get_context('spawn')
+        config = dict(self.config, struct=self.config['struct'].__name__) # modules can't be pickled
+        # without the vocab masks and shortlist table: they may be gpu tensors, which workers would initialize cuda to unpickle
+        state = dict(self.state_dict(), masks={}, shortlist_table=None)
+        queues = [context.Queue(self.data_prefetch) for _ in range(num_workers)]
+        workers = [context.Process(target=produce_batches,
+                                   args=(config, state, corpus.prefix, windows[i::num_workers], is_training, i, num_workers, seed, queues[i]),
+                                   daemon=True)
+                   for i in range(num_workers)]
+        for worker in workers:
+            worker.start()
+
+        def get_window(i):
+            worker, queue = workers[i % num_workers], queues[i % num_workers]
+            while True:
+                try:
+                    return queue.get(timeout=1)
+                except Empty:
+                    # a worker that died before it could report an exception (e.g. while starting up) would hang us
+                    if not worker.is_alive(): return RuntimeError(f'Batch worker {i % num_workers} exited with code {worker.exitcode}')
+
+        def collect_batches():
+            try:
+                for i in range(len(windows)):
+                    batches = get_window(i)
+                    if isinstance(batches, Exception): raise batches
+                    yield from zip(*batches)
+            finally:
+                for worker in workers:
+                    worker.terminate()
+                    worker.join()
+        return collect_batches()
 
     def get_batches(self, mode=ac.TRAINING, num_preload=ac.DEFAULT_NUM_PRELOAD):
-        ids_file = self.ids_files[mode]
+        corpus = Corpus(self.corpus_files[mode])
         is_training = mode == ac.TRAINING
+        order = numpy.arange(len(corpus))
         if is_training:
             # Shuffle training dataset
             start = time.time()
-            ut.shuffle_file(ids_file)
+            if self.shuffle_mode == ac.SHUFFLE_REWRITE:
+                corpus.shuffle()
+            else:
+                order = ut.shuffle_indices(len(corpus))
             end = time.time()
-            self.logger.info(f'Shuffling {ids_file} took {ut.format_time(end - start)}')
+            self.logger.info(f'Shuffling {corpus.prefix} took {ut.format_time(end - start)}')
+
+        windows = self.plan_batches(corpus, order, is_training, num_preload)
+        if is_training:
+            self.log_batch_stats(corpus, windows)
+            windows = self.shard_windows(windows)
 
-        with open(ids_file, 'r') as f:
-            yield from self.read_batches(f, is_training, num_preload, to_ids=False, with_trg=True)
+        seed = numpy.random.randint(2 ** 31 - len(windows)) # reproducible under ac.SEED
+        if self.num_data_workers > 0:
+            batches = self.read_corpus_batches_async(corpus, windows, is_training, seed)
+        else:
+            batches = self.read_corpus_batches(corpus, windows, is_training, seed)
+        yield from self.tensorize_batches(batches)
 
     def _ids_to_trans(self, trans_ids):
         words = []
@@ -320,10 +588,10 @@ class DataManager(object):
         return u' '.join(words)
 
     def detach_outputs(self, rets):
-        for ret in rets:
-            yield (ret['probs'].detach().cpu().numpy().reshape([-1]),
-                   ret['scores'].detach().cpu().numpy().reshape([-1]),
-                   ret['symbols'].detach().cpu().numpy())
+        "Yields the probs, scores and symbols of each sentence in rets (see Decoder.beam_decode), copied to the cpu once per batch"
+        yield from zip(rets['probs'].detach().cpu().numpy(),
+                       rets['scores'].detach().cpu().numpy(),
+                       rets['symbols'].detach().cpu().numpy())
 
     def get_trans(self, probs, scores, symbols):
         sorted_rows = numpy.argsort(scores)[::-1]
@@ -356,7 +624,7 @@ class DataManager(object):
             best_trans_cache = [None] * num_preload
             beam_trans_cache = [None] * num_preload
             for idxs, src_toks, src_structs, _, _ in self.read_batches(input_stream, False, num_preload, to_ids, with_trg=False):
-                rets = self.detach_outputs(model.beam_decode(src_toks, src_structs))
+                rets = self.detach_outputs(model.decode(src_toks, src_structs))
                 for i, ret in enumerate(rets):
                     i2 = idxs[i]
                     best, beam = self.get_trans(*ret)
@@ -395,6 +663,7 @@ class DataManager(object):
         self.trg_ivocab = state_dict['trg_ivocab']
         self.vocab_masks = state_dict['masks']
         self.training_tok_counts = state_dict['training_tok_counts']
+        self.shortlist_table = state_dict.get('shortlist_table') # absent from older checkpoints
 
     def state_dict(self):
         return {
@@ -404,6 +673,7 @@ class DataManager(object):
             'trg_ivocab':self.trg_ivocab,
             'masks':self.vocab_masks,
             'training_tok_counts':self.training_tok_counts,
+            'shortlist_table':self.shortlist_table,
         }
         
     def parse_line(self, line, is_src, max_len=None, to_ids=False):
@@ -419,3 +689,72 @@ class DataManager(object):
             if to_ids:
                 s = [ac.BOS_ID] + [self.trg_vocab.get(w, ac.UNK_ID) for w in s]
         return s
+
+
+def produce_batches(config, state, corpus_prefix, windows, is_training, worker_id, num_workers, seed, queue):
+    """
+    Worker loop of DataManager.read_corpus_batches_async, putting the untensorized batches of each window in queue,
+    where windows are this worker's share (windows worker_id, worker_id + num_workers, ... of the epoch)
+    """
+    try:
+        data_manager = DataManager(dict(config, struct=importlib.import_module(config['struct'])), init_vocab=False)
+        data_manager.load_state_dict(state)
+        corpus = Corpus(corpus_prefix)
+        for i, batches in zip(range(worker_id, num_workers * len(windows), num_workers), windows):
+            queue.put(data_manager.prepare_window(corpus, batches, is_training, numpy.random.RandomState(seed + i)))
+    except Exception:
+        queue.put(RuntimeError(f'Batch worker {worker_id} failed:\n{traceback.format_exc()}'))
+
+
+class TensorSlot(object):
+    "Reusable int64 buffers that one batch's token id arrays are tensorized into"
+
+    def __init__(self, device, pin_memory=False):
+        self.device = device
+        self.pin_memory = pin_memory
+        self.buffers = [torch.empty(0, dtype=torch.long, pin_memory=pin_memory) for _ in range(3)]
+        self.copied = None # cuda event marking the end of the last non_blocking copy out of the buffers
+
+    def fill(self, i, array):
+        "Copies array into buffer i (growing it if needed) and returns it as a tensor on the device"
+        if array.size > self.buffers[i].numel():
+            self.buffers[i] = torch.empty(max(array.size, 2 * self.buffers[i].numel()), dtype=torch.long, pin_memory=self.pin_memory)
+        x = self.buffers[i][:array.size].view(array.shape)
+        x.copy_(torch.from_numpy(array))
+        return x.to(self.device, non_blocking=self.pin_memory)
+
+    def tensorize(self, batch):
+        original_idxs, src_inputs, src_structs, trg_inputs, trg_target = batch
+        if self.copied is not None:
+            self.copied.synchronize() # the buffers may still be being copied from
+        batch = (original_idxs,
+                 self.fill(0, src_inputs),
+                 src_structs,
+                 self.fill(1, trg_inputs),
+                 self.fill(2, trg_target))
+        if self.pin_memory:
+            self.copied = torch.cuda.Event()
+            self.copied.record()
+        return batch
+
+
+def put_unless_stopped(queue, item, stop):
+    "Puts item in queue, waiting for a free spot until stop is set. Returns if item was put."
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+def tensorize_in_background(batches, slots, ready, stop):
+    "Thread loop of DataManager.tensorize_batches_async, tensorizing batch i into slots[i % len(slots)], then None when done"
+    try:
+        for i, batch in enumerate(batches):
+            if not put_unless_stopped(ready, slots[i % len(slots)].tensorize(batch), stop): return
+        put_unless_stopped(ready, None, stop)
+    except Exception:
+        put_unless_stopped(ready, RuntimeError(f'Tensorizing thread failed:\n{traceback.format_exc()}'), stop)
+    finally:
+        batches.close()
@@ -2,18 +2,19 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+import nmt.all_constants as ac
 from nmt.sublayers import Attention, PositionWiseFeedForward
 
 
 class Encoder(nn.Module):
     """Self-attention Encoder"""
-    def __init__(self, num_layers, num_heads, embed_dim, ff_dim, dropout=0., norm_in=True):
+    def __init__(self, num_layers, num_heads, embed_dim, ff_dim, dropout=0., norm_in=True, att_backend=ac.ATT_MATH):
         super(Encoder, self).__init__()
         self.self_atts = nn.ModuleList([])
         self.pos_ffs = nn.ModuleList([])
         self.lnorms = nn.ModuleList([])
         for i in range(num_layers):
-            self.self_atts.append(Attention(embed_dim, num_heads, dropout=dropout))
+            self.self_atts.append(Attention(embed_dim, num_heads, dropout=dropout, backend=att_backend))
             self.pos_ffs.append(PositionWiseFeedForward(embed_dim, ff_dim, dropout=dropout))
             self.lnorms.append(nn.ModuleList([nn.LayerNorm(embed_dim, eps=1e-6) for _ in range(2)]))
 
@@ -53,15 +54,15 @@ class Encoder(nn.Module):
 
 class Decoder(nn.Module):
     """Self-attention Decoder"""
-    def __init__(self, num_layers, num_heads, embed_dim, ff_dim, dropout=0., norm_in=True):
+    def __init__(self, num_layers, num_heads, embed_dim, ff_dim, dropout=0., norm_in=True, att_backend=ac.ATT_MATH):
         super(Decoder, self).__init__()
         self.self_atts = nn.ModuleList([])
         self.enc_dec_atts = nn.ModuleList([])
         self.pos_ffs = nn.ModuleList([])
         self.lnorms = nn.ModuleList([])
         for i in range(num_layers):
-            self.self_atts.append(Attention(embed_dim, num_heads, dropout=dropout))
-            self.enc_dec_atts.append(Attention(embed_dim, num_heads, dropout=dropout))
+            self.self_atts.append(Attention(embed_dim, num_heads, dropout=dropout, backend=att_backend))
+            self.enc_dec_atts.append(Attention(embed_dim, num_heads, dropout=dropout, backend=att_backend))
             self.pos_ffs.append(PositionWiseFeedForward(embed_dim, ff_dim, dropout=dropout))
             self.lnorms.append(nn.ModuleList([nn.LayerNorm(embed_dim, eps=1e-6) for _ in range(3)]))
 
@@ -105,19 +106,61 @@ class Decoder(nn.Module):
 
         return self.maybe_layernorm(x, self.last_lnorm, norm_in)
 
-    def beam_step(self, inp, cache):
-        norm_in = self.last_lnorm is not None
-        bsz, beam_size = cache['encoder_mask'].size()[:2]
-        cache['encoder_mask'] = cache['encoder_mask'].reshape(bsz * beam_size, 1, 1, -1)
+    def init_cache(self, encoder_out, encoder_mask, max_len, beam_size=1):
+        """
+        Returns the decoding cache for encoder_out [bsz, length, D]: per layer, the encoder keys/values
+        and a self-attention key/value buffer for up to bsz x beam_size hypotheses and max_len steps, each split into heads
+        ([bsz x num_heads, length, head_dim] and [bsz x beam_size x num_heads, max_len, head_dim]),
+        and cache['length'] steps decoded so far. The hypotheses decoded are the first rows of the buffers.
+        The encoder keys/values (and mask) are kept once per sentence, and shared by all its hypotheses.
+        """
+        bsz = encoder_out.size()[0]
+        cache = {'encoder_mask': encoder_mask, 'length': 0} # [bsz, 1, 1, length]
+        for i in range(self.num_layers):
+            self_att = self.self_atts[i]
+            enc_dec_att = self.enc_dec_atts[i]
+            k, v = enc_dec_att.split_heads(enc_dec_att.in_proj_k(encoder_out), enc_dec_att.in_proj_v(encoder_out))
+            cache[i] = {
+                'self_att': {
+                    'k': k.new_empty(bsz * beam_size * self_att.num_heads, max_len, self_att.head_dim),
+                    'v': v.new_empty(bsz * beam_size * self_att.num_heads, max_len, self_att.head_dim)
+                },
+                'enc_dec_k': k,
+                'enc_dec_v': v
+            }
+        return cache
+
+    def select_hyps(self, cache, idxs):
+        """
+        Makes the hypotheses idxs (indices over them, e.g. each new hypothesis' parent) the first rows of cache's
+        self-attention buffers, in that order, in place and on the decoded steps only
+        """
+        length = cache['length']
+        num_hyps = idxs.size()[0]
+        for i in range(self.num_layers):
+            num_heads = self.self_atts[i].num_heads
+            for x in cache[i]['self_att'].values():
+                x = x.reshape(-1, num_heads, *x.size()[1:]) # a view, [max hyps, num_heads, max_len, head_dim]
+                x[:num_hyps, :, :length] = x[idxs, :, :length]
+
+    def select_sents(self, cache, idxs):
+        "Keeps the sentences idxs (a bool mask or indices over them) of cache's encoder keys/values, in that order"
+        cache['encoder_mask'] = cache['encoder_mask'][idxs]
         for i in range(self.num_layers):
-            seq_len = cache[i]['enc_dec_k'].size()[2]
-            cache[i]['enc_dec_k'] = cache[i]['enc_dec_k'].reshape(bsz * beam_size, seq_len, -1)
-            cache[i]['enc_dec_v'] = cache[i]['enc_dec_v'].reshape(bsz * beam_size, seq_len, -1)
+            num_heads = self.enc_dec_atts[i].num_heads
+            for name in ['enc_dec_k', 'enc_dec_v']:
+                x = cache[i][name].reshape(-1, num_heads, *cache[i][name].size()[1:])[idxs] # [sents, num_heads, length, head_dim]
+                cache[i][name] = x.reshape(-1, *x.size()[2:])
 
-            if cache[i]['self_att']['k'] is not None:
-                seq_len = cache[i]['self_att']['k'].size()[2]
-                cache[i]['self_att']['k'] = cache[i]['self_att']['k'].reshape(bsz * beam_size, seq_len, -1)
-                cache[i]['self_att']['v'] = cache[i]['self_att']['v'].reshape(bsz * beam_size, seq_len, -1)
+    def beam_step(self, inp, cache):
+        """
+        Decodes one more step from inp [bsz x beam, 1, D], attending to the cache (see init_cache).
+        This step's self-attention keys/values are written in place at position cache['length'],
+        in the first bsz x beam rows of the buffers.
+        """
+        norm_in = self.last_lnorm is not None
+        step = cache['length']
+        bsz = cache['encoder_mask'].size()[0]
 
         x = inp # [bsz x beam, 1, D]
         for i in range(self.num_layers):
@@ -128,24 +171,22 @@ class Decoder(nn.Module):
 
             residual = x
             x = self.maybe_layernorm(x, lnorms[0], norm_in)
-            q, k, v = self_att.linear_projection(x, x, x)
-            if cache[i]['self_att']['k'] is not None:
-                k = torch.cat((cache[i]['self_att']['k'], k), 1)
-                v = torch.cat((cache[i]['self_att']['v'], v), 1)
+            q, k, v = self_att.split_heads(*self_att.linear_projection(x, x, x))
+            cache_k = cache[i]['self_att']['k'][:q.size()[0]]
+            cache_v = cache[i]['self_att']['v'][:q.size()[0]]
+            cache_k[:, step:step + 1] = k
+            cache_v[:, step:step + 1] = v
 
-            cache[i]['self_att']['k'] = k
-            cache[i]['self_att']['v'] = v
-
-            x, _ = self_att(q=q, k=k, v=v, mask=None, do_proj=False)
+            x, _ = self_att.attend(q, cache_k[:, :step + 1], cache_v[:, :step + 1], mask=None)
             x = residual + x
             x = self.maybe_layernorm(x, lnorms[0], not norm_in)
 
             residual = x
             x = self.maybe_layernorm(x, lnorms[1], norm_in)
-            q = enc_dec_att.in_proj_q(x)
-            k = cache[i]['enc_dec_k']
-            v = cache[i]['enc_dec_v']
-            x, _ = enc_dec_att(q=q, k=k, v=v, mask=cache['encoder_mask'], do_proj=False)
+            # each sentence's hypotheses are its queries, so they share its encoder keys/values
+            q, = enc_dec_att.split_heads(enc_dec_att.in_proj_q(x).reshape(bsz, -1, x.size()[-1])) # [bsz x num_heads, beam, head_dim]
+            x, _ = enc_dec_att.attend(q, cache[i]['enc_dec_k'], cache[i]['enc_dec_v'], mask=cache['encoder_mask'])
+            x = x.reshape(residual.size())
             x = residual + x
             x = self.maybe_layernorm(x, lnorms[1], not norm_in)
 
@@ -155,37 +196,24 @@ class Decoder(nn.Module):
             x = residual + x
             x = self.maybe_layernorm(x, lnorms[2], not norm_in)
 
-        x = self.maybe_layernorm(x, self.last_lnorm, norm_in)
-
-        cache['encoder_mask'] = cache['encoder_mask'].reshape(bsz, beam_size, 1, 1, -1)
-        for i in range(self.num_layers):
-            seq_len = cache[i]['enc_dec_k'].size()[1]
-            cache[i]['enc_dec_k'] = cache[i]['enc_dec_k'].reshape(bsz, beam_size, seq_len, -1)
-            cache[i]['enc_dec_v'] = cache[i]['enc_dec_v'].reshape(bsz, beam_size, seq_len, -1)
-
-            seq_len = cache[i]['self_att']['k'].size()[1]
-            cache[i]['self_att']['k'] = cache[i]['self_att']['k'].reshape(bsz, beam_size, seq_len, -1)
-            cache[i]['self_att']['v'] = cache[i]['self_att']['v'].reshape(bsz, beam_size, seq_len, -1)
-
-        return x
+        cache['length'] = step + 1
+        return self.maybe_layernorm(x, self.last_lnorm, norm_in)
 
     def beam_decode(self, encoder_out, encoder_mask, get_input_fn, logprob_fn, length_fn, bos_id, eos_id, max_len, beam_size=4):
         """
-        Return: a list of dicts
-        - ret[i]['symbols'][j][k] is the kth word of jth translation of sentence i
-        - ret[i]['probs'][j] is the log-probability of the jth translation of sentence i
-        - ret[i]['scores'][j] is the score (including length penalty) of the jth translation of sentence i
+        Return: a dict of batched tensors
+        - ret['symbols'][i][j][k] is the kth word of jth translation of sentence i
+          (translations shorter than the longest one are padded with eos_id)
+        - ret['probs'][i][j] is the log-probability of the jth translation of sentence i
+        - ret['scores'][i][j] is the score (including length penalty) of the jth translation of sentence i
         """
         # first step, beam=1
         batch_size = encoder_out.size()[0]
+        maximum_length = max_len.max().item()
 
         # The first input symbol is BOS
         inp = get_input_fn(torch.tensor([bos_id] * batch_size).reshape(batch_size, 1), 0) # [bsz, 1, D]
-        cache = {'encoder_mask': encoder_mask.unsqueeze_(1)} # [bsz, beam, 1, 1, length]
-        for i in range(self.num_layers):
-            cache[i] = {'self_att': {'k': None, 'v': None}}
-            cache[i]['enc_dec_k'] = self.enc_dec_atts[i].in_proj_k(encoder_out).unsqueeze_(1)
-            cache[i]['enc_dec_v'] = self.enc_dec_atts[i].in_proj_v(encoder_out).unsqueeze_(1)
+        cache = self.init_cache(encoder_out, encoder_mask, maximum_length, beam_size)
 
         # Compute log-probabilities of all extensions of initial hyps
         y = self.beam_step(inp, cache).squeeze_(1) # [bsz, D]
@@ -201,46 +229,44 @@ class Decoder(nn.Module):
         last_scores = last_probs.clone()
         all_symbols = symbols.reshape(batch_size, beam_size, 1)
 
-        cache['encoder_mask'] = encoder_mask.expand(-1, beam_size, -1, -1, -1)
-        for i in range(self.num_layers):
-            cache[i]['self_att']['k'] = cache[i]['self_att']['k'].expand(-1, beam_size, -1, -1)
-            cache[i]['self_att']['v'] = cache[i]['self_att']['v'].expand(-1, beam_size, -1, -1)
-            cache[i]['enc_dec_k'] = cache[i]['enc_dec_k'].expand(-1, beam_size, -1, -1)
-            cache[i]['enc_dec_v'] = cache[i]['enc_dec_v'].expand(-1, beam_size, -1, -1)
+        self.select_hyps(cache, torch.arange(batch_size, device=encoder_out.device).repeat_interleave(beam_size))
 
         num_classes = probs.size()[-1] # V
-        not_eos_mask = (torch.arange(num_classes).reshape(1, -1) != eos_id).type(encoder_mask.type())
-        maximum_length = max_len.max().item()
-        ret = [None] * batch_size
-        batch_idxs = torch.arange(batch_size)
+        not_eos_mask = (torch.arange(num_classes, device=probs.device).reshape(1, -1) != eos_id).type(encoder_mask.type())
+
+        # Finished translations are written here, at the index of their sentence
+        ret = {
+            'symbols': all_symbols.new_full((batch_size, beam_size, maximum_length), eos_id),
+            'probs': last_probs.new_empty(batch_size, beam_size),
+            'scores': last_scores.new_empty(batch_size, beam_size)
+        }
+        def store(idxs):
+            ret['symbols'][batch_idxs[idxs], :, :all_symbols.size()[-1]] = all_symbols[idxs]
+            ret['probs'][batch_idxs[idxs]] = last_probs[idxs]
+            ret['scores'][batch_idxs[idxs]] = last_scores[idxs]
+
+        batch_idxs = torch.arange(batch_size, device=probs.device)
         for time_step in range(1, maximum_length + 1):
 
             # Add finished outputs to ret and remove them from beam
             surpass_length = (max_len < time_step) + (time_step == maximum_length)
             finished_decoded = torch.sum(all_symbols[:, :, -1] == eos_id, -1) == beam_size
             finished_sents = ((surpass_length + finished_decoded) >= 1).type(encoder_mask.type())
-            if finished_sents.any():
-                for j in range(finished_sents.size()[0]):
-                    if finished_sents[j]:
-                        ret[batch_idxs[j]] = {
-                            'symbols': all_symbols[j].clone(),
-                            'probs': last_probs[j].clone(),
-                            'scores': last_scores[j].clone()
-                        }
-
-                all_symbols = all_symbols[~finished_sents]
-                last_probs = last_probs[~finished_sents]
-                last_scores = last_scores[~finished_sents]
-                max_len = max_len[~finished_sents]
-                batch_idxs = batch_idxs[~finished_sents]
-                cache['encoder_mask'] = cache['encoder_mask'][~finished_sents]
-                for i in range(self.num_layers):
-                    cache[i]['self_att']['k'] = cache[i]['self_att']['k'][~finished_sents]
-                    cache[i]['self_att']['v'] = cache[i]['self_att']['v'][~finished_sents]
-                    cache[i]['enc_dec_k'] = cache[i]['enc_dec_k'][~finished_sents]
-                    cache[i]['enc_dec_v'] = cache[i]['enc_dec_v'][~finished_sents]
-
-            if finished_sents.all():
+            # unfinished sentences first, keeping their order (the only host sync of the step)
+            sent_order = torch.sort(finished_sents.type(torch.uint8), stable=True)[1]
+            num_unfinished = finished_sents.size()[0] - finished_sents.sum().item()
+            if num_unfinished < finished_sents.size()[0]:
+                store(sent_order[num_unfinished:])
+                keep = sent_order[:num_unfinished]
+                all_symbols = all_symbols[keep]
+                last_probs = last_probs[keep]
+                last_scores = last_scores[keep]
+                max_len = max_len[keep]
+                batch_idxs = batch_idxs[keep]
+                self.select_sents(cache, keep)
+                self.select_hyps(cache, (keep.unsqueeze(1) * beam_size + torch.arange(beam_size, device=keep.device)).reshape(-1))
+
+            if num_unfinished == 0:
                 break
 
             bsz = all_symbols.size()[0]
@@ -255,20 +281,14 @@ class Decoder(nn.Module):
 
             # Finished hypotheses are zeroed out
             # For unfinished hypotheses, update log-probs and scores
-            finished_mask = (last_symbols.reshape(-1) == eos_id).type(encoder_mask.type())
-            beam_probs = probs.clone()
-            if finished_mask.any():
-                beam_probs[finished_mask] = last_probs[finished_mask].expand(-1, num_classes).masked_fill(not_eos_mask, float('-inf'))
-                beam_probs[~finished_mask] = last_probs[~finished_mask] + probs[~finished_mask]
-            else:
-                beam_probs = last_probs + probs
-
-            beam_scores = beam_probs.clone()
-            if finished_mask.any():
-                beam_scores[finished_mask] = last_scores[finished_mask].expand(-1, num_classes).masked_fill(not_eos_mask, float('-inf'))
-                beam_scores[~finished_mask] = length_fn(time_step, beam_probs[~finished_mask])
-            else:
-                beam_scores = length_fn(time_step, beam_probs)
+            # (selected with torch.where rather than masks, to avoid host syncs)
+            finished_mask = (last_symbols.reshape(-1, 1) == eos_id) # [bsz x beam, 1]
+            beam_probs = torch.where(finished_mask,
+                                     last_probs.expand(-1, num_classes).masked_fill(not_eos_mask, float('-inf')),
+                                     last_probs + probs)
+            beam_scores = torch.where(finished_mask,
+                                      last_scores.expand(-1, num_classes).masked_fill(not_eos_mask, float('-inf')),
+                                      length_fn(time_step, beam_probs))
 
             # Select top k hypotheses to survive to next time step
             beam_probs = beam_probs.reshape(bsz, -1)   # [bsz, beam x V]
@@ -279,24 +299,158 @@ class Decoder(nn.Module):
 
             last_probs = torch.gather(beam_probs, -1, idxs)
             last_scores = max_scores
-            parent_idxs = parent_idxs + torch.arange(bsz).unsqueeze_(1).type(parent_idxs.type()) * beam_size
+            parent_idxs = parent_idxs + torch.arange(bsz, device=parent_idxs.device).unsqueeze_(1) * beam_size
             parent_idxs = parent_idxs.reshape(-1)
             all_symbols = all_symbols.reshape(bsz * beam_size, -1)[parent_idxs].reshape(bsz, beam_size, -1)
             all_symbols = torch.cat((all_symbols, symbols.unsqueeze_(-1)), -1)
-
-            for i in range(self.num_layers):
-                seq_len = cache[i]['self_att']['k'].size()[2]
-                cache[i]['self_att']['k'] = cache[i]['self_att']['k'].reshape(bsz * beam_size, seq_len, -1)[parent_idxs].reshape(bsz, beam_size, seq_len, -1)
-                cache[i]['self_att']['v'] = cache[i]['self_att']['v'].reshape(bsz * beam_size, seq_len, -1)[parent_idxs].reshape(bsz, beam_size, seq_len, -1)
+            self.select_hyps(cache, parent_idxs)
 
         # if some hypotheses have not reached EOS yet and are cut off by length limit
         # make sure they are returned
         if batch_idxs.size()[0] > 0:
-            for j in range(batch_idxs.size()[0]):
-                ret[batch_idxs[j]] = {
-                    'symbols': all_symbols[j].clone(),
-                    'probs': last_probs[j].clone(),
-                    'scores': last_scores[j].clone()
-                }
+            store(slice(None))
+
+        return ret
+
+    def pruned_beam_decode(self, encoder_out, encoder_mask, get_input_fn, logprob_fn, length_fn, bos_id, eos_id, max_len, beam_size=4):
+        """
+        Beam search in which hypotheses leave the beam once they end with eos, so only live ones are decoded,
+        and each sentence stops as soon as none of its live hypotheses can outscore its best finished one.
+        At each step, the best beam_size extensions that do not end with eos stay in the beam,
+        and those ending with eos among the best beam_size extensions are set aside as finished.
+        The bound assumes length_fn(t, p) is monotonic in t, as in the GNMT, linear and no length models.
+
+        Return: See beam_decode
+        """
+        # first step, beam=1
+        batch_size = encoder_out.size()[0]
+        maximum_length = max_len.max().item()
+
+        # The first input symbol is BOS
+        inp = get_input_fn(torch.tensor([bos_id] * batch_size).reshape(batch_size, 1), 0) # [bsz, 1, D]
+        cache = self.init_cache(encoder_out, encoder_mask, maximum_length, beam_size)
+
+        # Compute log-probabilities of all extensions of initial hyps
+        y = self.beam_step(inp, cache).squeeze_(1) # [bsz, D]
+        probs = logprob_fn(y) # [bsz, V]
+        probs[:, eos_id] = float('-inf') # no <eos> now to avoid empty output
+
+        # Select top k hyps to survive to the next time step (length penalty not needed, because all lengths are 1)
+        last_probs, symbols = torch.topk(probs, beam_size, dim=-1) # ([bsz, beam], [bsz, beam])
+        all_symbols = symbols.reshape(batch_size, beam_size, 1)
+        self.select_hyps(cache, torch.arange(batch_size, device=probs.device).repeat_interleave(beam_size))
+
+        num_classes = probs.size()[-1] # V
+
+        # The best beam_size finished translations of each sentence, at its index
+        ret = {
+            'symbols': all_symbols.new_full((batch_size, beam_size, maximum_length), eos_id),
+            'probs': last_probs.new_full((batch_size, beam_size), float('-inf')),
+            'scores': last_probs.new_full((batch_size, beam_size), float('-inf'))
+        }
+        def store(idxs, symbols, probs, scores):
+            "Merges the translations symbols [n, k, length] (with probs, scores [n, k]) of sentences idxs into ret"
+            sents = batch_idxs[idxs]
+            symbols = F.pad(symbols, (0, maximum_length - symbols.size()[-1]), value=eos_id)
+            symbols = torch.cat((ret['symbols'][sents], symbols), 1)
+            probs = torch.cat((ret['probs'][sents], probs), 1)
+            scores, best = torch.topk(torch.cat((ret['scores'][sents], scores), 1), beam_size, dim=-1)
+            ret['symbols'][sents] = symbols.gather(1, best.unsqueeze(-1).expand(-1, -1, maximum_length))
+            ret['probs'][sents] = probs.gather(-1, best)
+            ret['scores'][sents] = scores
+
+        batch_idxs = torch.arange(batch_size, device=probs.device)
+        for time_step in range(1, maximum_length + 1):
+
+            # Log-probs only decrease, so a live hypothesis scores at most as much as now or at the length limit
+            live_scores = length_fn(time_step - 1, last_probs)
+            bound = torch.max(live_scores, length_fn(max_len.unsqueeze(1), last_probs)).max(dim=-1)[0]
+            surpass_length = (max_len < time_step) | (time_step == maximum_length)
+            finished_sents = surpass_length | (ret['scores'][batch_idxs].max(dim=-1)[0] >= bound)
+
+            # unfinished sentences first, keeping their order (the only host sync of the step)
+            sent_order = torch.sort(finished_sents.type(torch.uint8), stable=True)[1]
+            num_unfinished = finished_sents.size()[0] - finished_sents.sum().item()
+            if num_unfinished < finished_sents.size()[0]:
+                # their live hypotheses fill any slots left by the finished ones
+                done = sent_order[num_unfinished:]
+                store(done, all_symbols[done], last_probs[done], live_scores[done])
+                keep = sent_order[:num_unfinished]
+                all_symbols = all_symbols[keep]
+                last_probs = last_probs[keep]
+                max_len = max_len[keep]
+                batch_idxs = batch_idxs[keep]
+                self.select_sents(cache, keep)
+                self.select_hyps(cache, (keep.unsqueeze(1) * beam_size + torch.arange(beam_size, device=keep.device)).reshape(-1))
+
+            if num_unfinished == 0:
+                break
+
+            bsz = all_symbols.size()[0]
+
+            # Use last output symbol as next input
+            inps = get_input_fn(all_symbols[:, :, -1], time_step).reshape(bsz * beam_size, -1).unsqueeze_(1) # [bsz x beam, 1, D]
+            probs = logprob_fn(self.beam_step(inps, cache).squeeze_(1)) # [bsz x beam, V]
+            beam_probs = (last_probs.reshape(-1, 1) + probs).reshape(bsz, -1) # [bsz, beam x V]
+            beam_scores = length_fn(time_step, beam_probs)
+
+            # Each hypothesis has one eos extension, so the best 2 x beam include at least beam others
+            cand_scores, cand_idxs = torch.topk(beam_scores, 2 * beam_size, dim=-1) # ([bsz, 2 x beam], [bsz, 2 x beam])
+            cand_probs = torch.gather(beam_probs, -1, cand_idxs)
+            cand_symbols = cand_idxs % num_classes
+            parent_idxs = cand_idxs // num_classes + torch.arange(bsz, device=cand_idxs.device).unsqueeze_(1) * beam_size
+            is_eos = cand_symbols == eos_id
+
+            # Set aside the eos extensions among the best beam
+            eos_symbols = all_symbols.reshape(bsz * beam_size, -1)[parent_idxs[:, :beam_size].reshape(-1)].reshape(bsz, beam_size, -1)
+            eos_symbols = torch.cat((eos_symbols, cand_symbols[:, :beam_size].unsqueeze(-1)), -1)
+            eos_scores = cand_scores[:, :beam_size].masked_fill(~is_eos[:, :beam_size], float('-inf'))
+            store(slice(None), eos_symbols, cand_probs[:, :beam_size], eos_scores)
+
+            # Keep the best beam others
+            live = torch.sort(is_eos.type(torch.uint8), dim=-1, stable=True)[1][:, :beam_size] # [bsz, beam]
+            parent_idxs = torch.gather(parent_idxs, -1, live).reshape(-1)
+            last_probs = torch.gather(cand_probs, -1, live)
+            symbols = torch.gather(cand_symbols, -1, live)
+            all_symbols = all_symbols.reshape(bsz * beam_size, -1)[parent_idxs].reshape(bsz, beam_size, -1)
+            all_symbols = torch.cat((all_symbols, symbols.unsqueeze_(-1)), -1)
+            self.select_hyps(cache, parent_idxs)
 
         return ret
+
+    def sample_decode(self, encoder_out, encoder_mask, get_input_fn, logprob_fn, length_fn, bos_id, eos_id, max_len, choose_fn):
+        """
+        Decodes one translation per sentence, choosing each word with choose_fn(log-probs [bsz, V]) -> [bsz]
+        (e.g. the most probable word, or a sampled one). There is no beam, so no hypotheses are reordered.
+
+        Return: See beam_decode, with a beam of 1
+        """
+        batch_size = encoder_out.size()[0]
+        maximum_length = max_len.max().item()
+        cache = self.init_cache(encoder_out, encoder_mask, maximum_length)
+
+        symbols = max_len.new_full((batch_size, maximum_length), eos_id)
+        probs = encoder_out.new_zeros(batch_size, dtype=torch.float)
+        lengths = max_len.new_zeros(batch_size) # number of words, including eos
+        finished = max_len.new_zeros(batch_size, dtype=torch.bool)
+        last_symbols = max_len.new_full((batch_size,), bos_id)
+        for time_step in range(maximum_length):
+            inp = get_input_fn(last_symbols.reshape(batch_size, 1), time_step) # [bsz, 1, D]
+            step_probs = logprob_fn(self.beam_step(inp, cache).squeeze_(1)) # [bsz, V]
+            if time_step == 0:
+                step_probs[:, eos_id] = float('-inf') # no <eos> now to avoid empty output
+
+            # Finished sentences only get more eos, which do not count
+            last_symbols = choose_fn(step_probs).masked_fill(finished, eos_id)
+            probs += step_probs.gather(-1, last_symbols.unsqueeze(1)).squeeze(1).masked_fill(finished, 0.)
+            lengths += ~finished
+            symbols[:, time_step] = last_symbols
+            finished = finished | (last_symbols == eos_id) | (lengths >= max_len)
+            if finished.all():
+                break
+
+        return {
+            'symbols': symbols.unsqueeze(1),
+            'probs': probs.unsqueeze(1),
+            'scores': length_fn(lengths - 1, probs).unsqueeze(1)
+        }
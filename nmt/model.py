@@ -3,6 +3,7 @@ import torch
 from torch import nn
 from torch.nn import Parameter
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from nmt.encoders import Encoder, Decoder
 import nmt.all_constants as ac
 import nmt.utils as ut
@@ -95,10 +96,11 @@ class Model(nn.Module):
         ff_dim = self.config['ff_dim']
         dropout = self.config['dropout']
         norm_in = self.config['norm_in']
+        att_backend = self.config['att_backend']
 
         # get encoder, decoder
-        self.encoder = Encoder(num_enc_layers, num_enc_heads, embed_dim, ff_dim, dropout=dropout, norm_in=norm_in)
-        self.decoder = Decoder(num_dec_layers, num_dec_heads, embed_dim, ff_dim, dropout=dropout, norm_in=norm_in)
+        self.encoder = Encoder(num_enc_layers, num_enc_heads, embed_dim, ff_dim, dropout=dropout, norm_in=norm_in, att_backend=att_backend)
+        self.decoder = Decoder(num_dec_layers, num_dec_heads, embed_dim, ff_dim, dropout=dropout, norm_in=norm_in, att_backend=att_backend)
 
         # leave layer norm alone
         init_func = nn.init.xavier_normal_ if self.config['weight_init_type'] == ac.XAVIER_NORMAL else nn.init.xavier_uniform_
@@ -129,11 +131,16 @@ class Model(nn.Module):
         embed_dim = self.config['embed_dim']
         pe = x.get_pos_embedding(embed_dim, **self.struct_params)
         if isinstance(pe, type(x)): pe = pe.flatten()
-        return pe if torch.is_tensor(pe) else torch.stack(pe) # [bsz, embed_dim]
+        return pe if torch.is_tensor(pe) else torch.stack(list(pe)) # [bsz, embed_dim]
     
     def get_pos_embedding(self, max_len, structs=None):
-        if structs is not None:
-            pe = [self.get_pos_embedding_h(x) for x in structs]
+        if structs is not None and hasattr(self.struct, 'get_pos_embeddings'):
+            # the trees' chains of matmuls lose too much precision in bf16
+            with ut.autocast(enabled=False):
+                return self.struct.get_pos_embeddings(structs, max_len, self.config['embed_dim'], **self.struct_params) # [bsz, max_len, embed_dim]
+        elif structs is not None:
+            with ut.autocast(enabled=False):
+                pe = [self.get_pos_embedding_h(x) for x in structs]
             return torch.nn.utils.rnn.pad_sequence(pe, batch_first=True) # [bsz, max_len, embed_dim]
         else:
             return self.pos_embedding_trg[:max_len, :].unsqueeze(0) # [1, max_len, embed_dim]
@@ -173,24 +180,31 @@ class Model(nn.Module):
 
         encoder_inputs, reg_penalty = self.get_input(src_toks, src_structs, calc_reg=hasattr(self.struct, "get_reg_penalty"))
         
-        encoder_outputs = self.encoder(encoder_inputs, encoder_mask_down)
+        with ut.autocast(self.config['mixed_precision']):
+            encoder_outputs = self.encoder(encoder_inputs, encoder_mask_down)
 
-        decoder_inputs, _ = self.get_input(trg_toks)
-        decoder_outputs = self.decoder(decoder_inputs, decoder_mask, encoder_outputs, encoder_mask)
+            decoder_inputs, _ = self.get_input(trg_toks)
+            decoder_outputs = self.decoder(decoder_inputs, decoder_mask, encoder_outputs, encoder_mask)
+        # the output layer, softmax and loss stay in fp32
+        decoder_outputs = decoder_outputs.float()
+
+        if self.config['loss_chunk_size'] > 0:
+            nll_loss, smooth_loss = self.chunked_losses(decoder_outputs, targets)
+        else:
+            logits = self.logit_fn(decoder_outputs)
+            neglprobs = F.log_softmax(logits, -1)
+            neglprobs = neglprobs * self.trg_vocab_mask.reshape(1, -1)
+            targets = targets.reshape(-1, 1)
+            non_pad_mask = targets != ac.PAD_ID
+            nll_loss = -neglprobs.gather(dim=-1, index=targets)
+            #nll_loss = nll_loss[non_pad_mask] # speed
+            nll_loss = nll_loss * non_pad_mask
+            #smooth_loss = -neglprobs.sum(dim=-1, keepdim=True)[non_pad_mask]
+            smooth_loss = -neglprobs.sum(dim=-1, keepdim=True) * non_pad_mask
+
+            nll_loss = nll_loss.sum()
+            smooth_loss = smooth_loss.sum()
 
-        logits = self.logit_fn(decoder_outputs)
-        neglprobs = F.log_softmax(logits, -1)
-        neglprobs = neglprobs * self.trg_vocab_mask.reshape(1, -1)
-        targets = targets.reshape(-1, 1)
-        non_pad_mask = targets != ac.PAD_ID
-        nll_loss = -neglprobs.gather(dim=-1, index=targets)
-        #nll_loss = nll_loss[non_pad_mask] # speed
-        nll_loss = nll_loss * non_pad_mask
-        #smooth_loss = -neglprobs.sum(dim=-1, keepdim=True)[non_pad_mask]
-        smooth_loss = -neglprobs.sum(dim=-1, keepdim=True) * non_pad_mask
-
-        nll_loss = nll_loss.sum()
-        smooth_loss = smooth_loss.sum()
         label_smoothing = self.config['label_smoothing']
 
         if label_smoothing > 0:
@@ -205,31 +219,94 @@ class Model(nn.Module):
             'nll_loss': nll_loss
         }
 
-    def logit_fn(self, decoder_output):
-        softmax_weight = self.out_embedding if not self.config['fix_norm'] else ut.normalize(self.out_embedding, scale=True)
-        logits = F.linear(decoder_output, softmax_weight, bias=self.out_bias)
+    def token_losses(self, decoder_output, targets):
+        "Returns the summed nll and (unnormalized) smoothing losses of predicting targets [n] from decoder_output [n, embed_dim]"
+        neglprobs = F.log_softmax(self.logit_fn(decoder_output), -1)
+        neglprobs = neglprobs * self.trg_vocab_mask.reshape(1, -1)
+        nll_loss = -neglprobs.gather(dim=-1, index=targets.reshape(-1, 1)).sum()
+        smooth_loss = -neglprobs.sum()
+        return nll_loss, smooth_loss
+
+    def chunked_losses(self, decoder_outputs, targets):
+        """
+        Same losses as the unchunked computation in forward, but only over the non-pad targets, loss_chunk_size
+        tokens at a time, so at most one chunk's [chunk, V] log-probs exist at once.
+        When training, each chunk is checkpointed: its log-probs are recomputed in the backward pass instead of kept.
+        """
+        chunk_size = self.config['loss_chunk_size']
+        targets = targets.reshape(-1)
+        non_pad_mask = targets != ac.PAD_ID
+        decoder_outputs = decoder_outputs.reshape(targets.size()[0], -1)[non_pad_mask]
+        targets = targets[non_pad_mask]
+
+        nll_loss = smooth_loss = decoder_outputs.new_zeros(())
+        for start in range(0, targets.size()[0], chunk_size):
+            chunk = decoder_outputs[start:start + chunk_size], targets[start:start + chunk_size]
+            if torch.is_grad_enabled():
+                chunk_nll_loss, chunk_smooth_loss = checkpoint(self.token_losses, *chunk, use_reentrant=False)
+            else:
+                chunk_nll_loss, chunk_smooth_loss = self.token_losses(*chunk)
+            nll_loss = nll_loss + chunk_nll_loss
+            smooth_loss = smooth_loss + chunk_smooth_loss
+        return nll_loss, smooth_loss
+
+    def output_layer(self, shortlist=None):
+        "Returns the output projection's weight, bias and vocab mask, restricted to the target ids in shortlist if given"
+        softmax_weight, bias, mask = self.out_embedding, self.out_bias, self.trg_vocab_mask
+        if shortlist is not None:
+            softmax_weight, bias, mask = softmax_weight[shortlist], bias[shortlist], mask[shortlist]
+        if self.config['fix_norm']:
+            softmax_weight = ut.normalize(softmax_weight, scale=True)
+        return softmax_weight, bias, mask
+
+    def logit_fn(self, decoder_output, output_layer=None):
+        softmax_weight, bias, mask = output_layer or self.output_layer()
+        # the softmax on top is computed in fp32, even under autocast
+        logits = F.linear(decoder_output, softmax_weight, bias=bias).float()
         logits = logits.reshape(-1, logits.size()[-1])
         #logits[:, ~self.trg_vocab_mask] = -1e9 # speed
-        logits.masked_fill_(~self.trg_vocab_mask.unsqueeze(0), -3e38) #-1e9)
+        logits.masked_fill_(~mask.unsqueeze(0), ut.min_value(logits)) #-1e9)
         return logits
 
-    def beam_decode(self, src_toks, src_structs):
-        """Translate a minibatch of sentences. 
+    def get_shortlist(self, src_toks):
+        """
+        Returns the sorted target ids decoding src_toks may output: the shortlist_size words co-occurring most with
+        each of its words (see DataManager.create_shortlist_table), the shortlist_frequent most frequent words, and eos/unk,
+        as far as they are in the target vocab mask. BOS is also included, as it is input to the decoder.
+        """
+        table = self.data_manager.shortlist_table
+        frequent = torch.arange(len(ac._START_VOCAB) + self.config['shortlist_frequent'], device=src_toks.device)
+        shortlist = torch.unique(torch.cat((table[src_toks].reshape(-1), frequent.clamp(max=self.trg_vocab_mask.size()[0] - 1))))
+        return shortlist[self.trg_vocab_mask[shortlist] | (shortlist == ac.BOS_ID)]
+
+    def decode(self, src_toks, src_structs):
+        """Translate a minibatch of sentences, with the decoder selected by config['decode_mode']
 
         Arguments: src_toks[i,j] is the jth word of sentence i.
 
-        Return: See encoders.Decoder.beam_decode
+        Return: See encoders.Decoder.beam_decode (greedy and sampled decoding return a beam of 1)
         """
         #encoder_mask = (src_toks == ac.PAD_ID).unsqueeze(1).unsqueeze(2) # [bsz, 1, 1, max_src_len]
         encoder_mask, encoder_mask_down = self.get_encoder_masks(src_toks, src_structs)
         encoder_inputs, _ = self.get_input(src_toks, src_structs)
-        encoder_outputs = self.encoder(encoder_inputs, encoder_mask_down)
+        autocast = ut.autocast(self.config['mixed_precision'])
+        with autocast:
+            encoder_outputs = self.encoder(encoder_inputs, encoder_mask_down)
         max_lengths1 = torch.sum(src_toks != ac.PAD_ID, dim=-1).type(src_toks.type()) + 50
         max_lengths2 = torch.tensor(self.config['max_trg_length']).type(src_toks.type())
         max_lengths = torch.min(max_lengths1, max_lengths2)
 
+        # With a shortlist, the decoder only sees (and outputs) indices into it
+        shortlist = None
+        bos_id, eos_id = ac.BOS_ID, ac.EOS_ID
+        if self.config['shortlist_size'] and self.data_manager.shortlist_table is not None:
+            shortlist = self.get_shortlist(src_toks)
+            bos_id, eos_id = torch.searchsorted(shortlist, torch.tensor([ac.BOS_ID, ac.EOS_ID], device=shortlist.device)).tolist()
+        output_layer = self.output_layer(shortlist)
+
         def get_trg_inp(ids, time_step):
             ids = ids.type(src_toks.type())
+            if shortlist is not None: ids = shortlist[ids]
             word_embeds = self.trg_embedding(ids)
             if self.config['fix_norm']:
                 word_embeds = ut.normalize(word_embeds, scale=False)
@@ -240,7 +317,7 @@ class Model(nn.Module):
             return word_embeds + pos_embeds * self.trg_pos_embed_scale
 
         def logprob(decoder_output):
-            return F.log_softmax(self.logit_fn(decoder_output), dim=-1)
+            return F.log_softmax(self.logit_fn(decoder_output, output_layer), dim=-1)
 
         if self.config['length_model'] == ac.GNMT_LENGTH_MODEL:
             length_model = ut.gnmt_length_model(self.config['length_alpha'])
@@ -251,7 +328,23 @@ class Model(nn.Module):
         else:
             raise ValueError('invalid length_model ' + str(self.config[length_model]))
 
-        return self.decoder.beam_decode(encoder_outputs, encoder_mask, get_trg_inp, logprob, length_model, ac.BOS_ID, ac.EOS_ID, max_lengths, beam_size=self.config['beam_size'])
+        decode_args = encoder_outputs, encoder_mask, get_trg_inp, logprob, length_model, bos_id, eos_id, max_lengths
+        with autocast:
+            if self.config['decode_mode'] == ac.BEAM_DECODE and self.config['beam_prune']:
+                ret = self.decoder.pruned_beam_decode(*decode_args, beam_size=self.config['beam_size'])
+            elif self.config['decode_mode'] == ac.BEAM_DECODE:
+                ret = self.decoder.beam_decode(*decode_args, beam_size=self.config['beam_size'])
+            elif self.config['decode_mode'] == ac.GREEDY_DECODE:
+                ret = self.decoder.sample_decode(*decode_args, choose_fn=ut.greedy_choice)
+            elif self.config['decode_mode'] == ac.SAMPLE_DECODE:
+                choose_fn = ut.sample_choice(self.config['sample_top_k'], self.config['sample_top_p'], self.config['sample_temperature'])
+                ret = self.decoder.sample_decode(*decode_args, choose_fn=choose_fn)
+            else:
+                raise ValueError('invalid decode_mode ' + str(self.config['decode_mode']))
+
+        if shortlist is not None:
+            ret['symbols'] = shortlist[ret['symbols']]
+        return ret
 
     def load_state_dict(self, loaded_dict, do_init=False):
         state_dict = loaded_dict['model']
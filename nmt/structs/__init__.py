@@ -14,5 +14,10 @@ for fn in os.listdir(cd):
 Each struct is a module with               type
 - a 'parse' function                       str, clip=int? -> Struct implementation (with size clipped to clip, if given)
 - a 'get_params' function                  config -> {name1: torch.Tensor(*), ...}
+- an 'unflatten' function                  values, topology -> Struct implementation (inverse of flatten and topology)
+- (optional) an 'unflatten_batch' function [values], [topology] -> [Struct implementation]
+                                           (batched equivalent of calling unflatten on each pair)
 - (optional) a get_reg_penalty function    torch.Tensor(batch_size, max_len, embed_dim) -> torch.Tensor()
+- (optional) a get_pos_embeddings function [Struct], max_len, embed_dim, **params -> torch.Tensor(batch_size, max_len, embed_dim)
+                                           (batched equivalent of calling get_pos_embedding on each Struct)
 """
@@ -25,6 +25,9 @@ class SequenceStruct(Struct):
 def parse(s, clip=None):
   return SequenceStruct(s.strip().split(maxsplit=(clip or -1))[slice(clip)])
 
+def unflatten(values, topology):
+  return SequenceStruct(list(values))
+
 def get_params(config):
   device = get_device()
   num_heads = config['num_enc_heads']
@@ -3,7 +3,7 @@ from nmt.structs.struct import Struct
 import nmt.structs.tree_utils as tree_utils
 import nmt.utils as ut
 
-class Tree(tree_utils.Tree):
+class Tree(tree_utils.ArrayTree):
 
   def get_pos_embedding(self, embed_dim, self_attn_weights):
     return torch.zeros(self.size(), embed_dim, device=self_attn_weights.device)
@@ -11,6 +11,12 @@ class Tree(tree_utils.Tree):
 def parse(fun_str, clip=None):
   return tree_utils.parse(fun_str, cls=Tree, clip=clip)
 
+def unflatten(values, topology):
+  return tree_utils.unflatten(values, topology, cls=Tree)
+
+def unflatten_batch(values, topologies):
+  return tree_utils.unflatten_batch(values, topologies, cls=Tree)
+
 def get_params(config):
   return dict(
     self_attn_weights = torch.zeros(len(tree_utils.HEAD_IDS[1:]), config['num_enc_heads'], device=ut.get_device()),
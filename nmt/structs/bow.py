@@ -25,5 +25,8 @@ class SequenceStruct(Struct):
 def parse(s, clip=None):
   return SequenceStruct(s.strip().split(maxsplit=(clip or -1))[slice(clip)])
 
+def unflatten(values, topology):
+  return SequenceStruct(list(values))
+
 def get_params(config):
   return {}
@@ -29,6 +29,9 @@ class SequenceStruct(Struct):
 def parse(s, clip=None):
   return SequenceStruct(s.strip().split(maxsplit=(clip or -1))[slice(clip)])
 
+def unflatten(values, topology):
+  return SequenceStruct(list(values))
+
 def get_params(config):
   #if config['learned_pos']:
   #  embed_dim = config['embed_dim']
@@ -1,3 +1,5 @@
+import numpy
+
 class Struct:
   '''
   Interface for the structure of a source language.
@@ -6,6 +8,9 @@ class Struct:
     get_pos_embedding(self, embed_dim, **params) - return a Struct with values that are torch.Tensors (vectors of length embed_dim)
     map(self, f) - return a Struct, after applying f to each value
     __str__ - must be isomorphic with parser
+  and may override
+    topology(self) - return a numpy.uint8 array describing the shape of this Struct, one entry per word
+    relation_mask(self) - return a numpy.uint16 matrix of word-pair relations to store alongside the ids
   Above, params is the list of torch.Tensors given in nmt.configurations under the field 'struct_params'.
   Each Struct subclass must also have some function that parses a string and returns the subclass,
   to be referenced in nmt.configurations under the field 'struct_parser'.
@@ -39,6 +44,14 @@ class Struct:
     'Sets all non-null node values to None'
     return self.map(lambda x: None)
   
+  def topology(self):
+    'Returns a numpy.uint8 array with one shape code per word, in the order of self.flatten()'
+    return numpy.zeros(self.size(), dtype=numpy.uint8)
+
+  def relation_mask(self):
+    '(Optional) Override to return a numpy.uint16 [size, size] matrix of word-pair relations, to precompute for get_enc_mask'
+    return None
+
   def maybe_add_eos(self, EOS_ID):
     '(Optional) Override if this struct needs an EOS token'
     pass
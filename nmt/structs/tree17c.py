@@ -2,7 +2,7 @@ import torch
 from nmt.structs.struct import Struct
 import nmt.structs.tree_utils as tree_utils
 
-class Tree(tree_utils.Tree):
+class Tree(tree_utils.ArrayTree):
 
   def get_pos_embedding(self, embed_dim, mu_l, mu_r, lam, c_l, c_r):
     cmu_l = mu_l * c_l
@@ -13,6 +13,15 @@ class Tree(tree_utils.Tree):
 def parse(fun_str, clip=None):
   return tree_utils.parse(fun_str, cls=Tree, clip=clip)
 
+def unflatten(values, topology):
+  return tree_utils.unflatten(values, topology, cls=Tree)
+
+def unflatten_batch(values, topologies):
+  return tree_utils.unflatten_batch(values, topologies, cls=Tree)
+
+def get_pos_embeddings(structs, max_len, embed_dim, mu_l, mu_r, lam, c_l, c_r):
+  return tree_utils.get_pos_embeddings(structs, max_len, lam, mu_l * c_l, mu_r * c_r)
+
 def get_params(config):
   embed_dim = config['embed_dim']
   return dict(
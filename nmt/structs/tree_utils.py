@@ -1,3 +1,4 @@
+import numpy
 import torch
 import nmt.utils as ut
 from nmt.structs.struct import Struct
@@ -14,6 +15,11 @@ class Record(object):
       return getattr(self, attr)
 
 
+# Flags returned by Tree.topology(), marking which nodes have a left child / right sibling
+TOPOLOGY_LEFT = 1
+TOPOLOGY_RIGHT = 2
+
+
 class Tree(Struct):
   
   def __init__(self, v, l=None, r=None):
@@ -72,6 +78,17 @@ class Tree(Struct):
       acc.append(node.v)
     return acc
 
+  def topology(self):
+    "Returns the TOPOLOGY_LEFT/TOPOLOGY_RIGHT flags of each node, in the order of self.flatten()"
+    stack = [self]
+    acc = []
+    while stack:
+      node = stack.pop()
+      if node.r: stack.append(node.r)
+      if node.l: stack.append(node.l)
+      acc.append((TOPOLOGY_LEFT if node.l else 0) | (TOPOLOGY_RIGHT if node.r else 0))
+    return numpy.array(acc, dtype=numpy.uint8)
+
   def set_clip_length(self, clip):
     if clip is None:
       return -1, self
@@ -108,6 +125,248 @@ class Tree(Struct):
     r = self.r.zip(other.r) if self.r else None
     return self.new(v, l, r)
 
+def as_values(values):
+  "Node values as a numpy array, keeping arbitrary Python objects as such"
+  return values if isinstance(values, numpy.ndarray) else ut.object_array(values)
+
+def link_topology(topology, offsets=None):
+  """
+  Vectorized inverse of Tree.topology() for the concatenated topologies of one or more trees,
+  tree k being topology[offsets[k]:offsets[k+1]] (a single tree if offsets is None).
+  Returns the ArrayTree arrays (parent, left, right, depth) and relations() (tree_parents, ends),
+  with each tree's node indices starting at 0.
+
+  Reading a topology in preorder keeps a stack of (node, is_left) slots waiting for their subtree:
+  every node but a root pops the top slot, then pushes its right sibling slot and then its left child slot.
+  The stack height follows from a cumsum of pushes minus pops, and as a slot at height h
+  is always popped before the next push at height h, each pop is matched to the latest push
+  at its height by a binary search over the (height, position) keys of the pushes.
+  """
+  topology = numpy.asarray(topology)
+  n = len(topology)
+  offsets = numpy.array([0, n], dtype=numpy.int64) if offsets is None else numpy.asarray(offsets, dtype=numpy.int64)
+  lengths = numpy.diff(offsets)
+  starts = numpy.repeat(offsets[:-1], lengths) # first node of each node's tree
+  stops = numpy.repeat(offsets[1:], lengths) # one past its last node
+  idx = numpy.arange(n, dtype=numpy.int64)
+
+  has_l = (topology & TOPOLOGY_LEFT > 0).astype(numpy.int64)
+  has_r = (topology & TOPOLOGY_RIGHT > 0).astype(numpy.int64)
+  pops = (idx != starts).astype(numpy.int64)
+  delta = has_l + has_r - pops
+  before = numpy.cumsum(delta) - delta # stack height when reaching each node
+  base = before - pops # stack height after its pop
+  key_scale = n + 1 # keys height * key_scale + position sort by height, then position
+
+  # pushes: right sibling slots at height base + 1, then left child slots on top of them
+  pushers = numpy.concatenate([idx[has_r > 0], idx[has_l > 0]])
+  push_keys = numpy.concatenate([(base + 1)[has_r > 0], (base + has_r + 1)[has_l > 0]]) * key_scale + pushers
+  push_is_left = numpy.concatenate([numpy.zeros(int(has_r.sum()), dtype=bool), numpy.ones(int(has_l.sum()), dtype=bool)])
+  order = numpy.argsort(push_keys, kind='stable')
+  pushers, push_keys, push_is_left = pushers[order], push_keys[order], push_is_left[order]
+
+  # each popping node attaches to the latest push at its height
+  poppers = idx[pops > 0]
+  pop_keys = before[poppers] * key_scale + poppers
+  order = numpy.argsort(pop_keys, kind='stable')
+  poppers, pop_keys = poppers[order], pop_keys[order]
+  pushed = numpy.searchsorted(push_keys, pop_keys) - 1
+  parent = numpy.full(n, -1, dtype=numpy.int64)
+  left = numpy.full(n, -1, dtype=numpy.int64)
+  right = numpy.full(n, -1, dtype=numpy.int64)
+  parent[poppers] = pushers[pushed]
+  left[pushers[pushed][push_is_left[pushed]]] = poppers[push_is_left[pushed]]
+  right[pushers[pushed][~push_is_left[pushed]]] = poppers[~push_is_left[pushed]]
+
+  # all siblings of a chain pop slots at the same height, which holds no other left child slot
+  # between their parent's push and them, so the tree parent is the latest left child push at that height
+  left_keys = push_keys[push_is_left]
+  left_pushers = pushers[push_is_left]
+  tree_parents = numpy.full(n, -1, dtype=numpy.int64)
+  found = numpy.searchsorted(left_keys, pop_keys) - 1
+  valid = found >= 0
+  valid[valid] = (left_keys[found[valid]] // key_scale == before[poppers][valid]) & (left_pushers[found[valid]] >= starts[poppers][valid])
+  tree_parents[poppers[valid]] = left_pushers[found[valid]]
+
+  # a node's descendants end at the first later pop below its left child slot
+  targets = base + has_r
+  found = numpy.searchsorted(pop_keys, targets * key_scale + idx, side='right')
+  ends = stops.copy()
+  valid = found < len(pop_keys)
+  valid[valid] = pop_keys[found[valid]] // key_scale == targets[valid]
+  ends[valid] = numpy.minimum(poppers[found[valid]], stops[valid])
+
+  # depth by pointer jumping: each step doubles the distance covered by up
+  depth = pops.copy()
+  up = numpy.where(parent >= 0, parent, idx)
+  while not numpy.array_equal(up, up[up]):
+    depth, up = depth + depth[up], up[up]
+
+  def local(x): return numpy.where(x >= 0, x - starts, -1).astype(numpy.int32)
+  return local(parent), local(left), local(right), depth.astype(numpy.int32), local(tree_parents), (ends - starts).astype(numpy.int32)
+
+class ArrayTree(Struct):
+  '''
+  The same left-child/right-sibling binary tree as Tree, stored as parallel arrays
+  indexed by preorder (i.e. self.flatten()) position instead of as linked nodes:
+    values[i] - value of node i (values is a numpy array, of dtype object unless given otherwise)
+    parent[i] - node whose left child or right sibling is i (-1 for the root)
+    left[i]   - left child (first child) of i, or -1
+    right[i]  - right sibling (next sibling) of i, or -1
+    depth[i]  - number of left/right links between the root and i
+  The index arrays are never modified, so trees of the same shape share them.
+  The shape arrays and relations() are built with array ops (see link_topology);
+  the generic folds below still call their f once per node, so batched code should
+  use index_paths, get_pos_embeddings and relation_masks instead.
+  '''
+
+  def __init__(self, values, parent, left, right, depth, relations=None, relation_mask=None):
+    self.values = values
+    self.parent = parent
+    self.left = left
+    self.right = right
+    self.depth = depth
+    self._relations = relations
+    self._relation_mask = relation_mask
+
+  def new(self, values):
+    "Returns a tree with the same shape as this one, but the given (preorder) values"
+    return self.__class__(values, self.parent, self.left, self.right, self.depth, self._relations, self._relation_mask)
+
+  @classmethod
+  def from_topology(cls, values, topology):
+    "Inverse of (tree.flatten(), tree.topology())"
+    parent, left, right, depth, tree_parents, ends = link_topology(topology)
+    return cls(as_values(values), parent, left, right, depth, relations=(tree_parents, ends))
+
+  @classmethod
+  def from_nested(cls, tree, clip=None):
+    "Builds a tree from the nested lists returned by parse_lc_rs_h, keeping only its first clip nodes"
+    values = []
+    topology = []
+    stack = [([tree], 0, -1, None)] # (siblings, position, node to attach to, attach as left child)
+    while stack and (clip is None or len(values) < clip):
+      siblings, pos, attach, is_left = stack.pop()
+      node = siblings[pos]
+      i = len(values)
+      if attach >= 0:
+        topology[attach] |= TOPOLOGY_LEFT if is_left else TOPOLOGY_RIGHT
+      values.append(node if isinstance(node, str) else node[0])
+      topology.append(0)
+      if pos + 1 < len(siblings):
+        stack.append((siblings, pos + 1, i, False))
+      if isinstance(node, list) and len(node) > 1:
+        stack.append((node, 1, i, True))
+    return cls.from_topology(values, topology)
+
+  def __str__(self):
+    strs = []
+    for i, v in enumerate(self.values):
+      if self.left[i] >= 0:
+        strs.append("(")
+        strs.append(str(v))
+        continue
+      strs.append(str(v))
+      # close the parentheses of every subtree that ends at i
+      x = i
+      if self.right[x] >= 0: continue
+      while self.parent[x] >= 0:
+        p = self.parent[x]
+        if self.left[p] == x:
+          strs.append(")")
+          if self.right[p] >= 0: break
+        x = p
+    return " ".join(strs)
+
+  def __repr__(self):
+    return self.__str__()
+
+  def size(self):
+    return len(self.parent)
+
+  def flatten(self):
+    return self.values
+
+  def topology(self):
+    return ((self.left >= 0) * TOPOLOGY_LEFT | (self.right >= 0) * TOPOLOGY_RIGHT).astype(numpy.uint8)
+
+  def map(self, f):
+    return self.new(ut.object_array([f(v) for v in self.values]))
+
+  def map_(self, f):
+    self.values = ut.object_array([f(v) for v in self.values])
+    return self
+
+  def forget(self):
+    return self.new(numpy.empty(self.size(), dtype=object))
+
+  def has_left(self):
+    return bool(self.size()) and self.left[0] >= 0
+  def has_right(self):
+    return bool(self.size()) and self.right[0] >= 0
+  def is_leaf(self):
+    return not (self.has_left() or self.has_right())
+
+  def set_clip_length(self, clip):
+    if clip is not None and clip < self.size():
+      self.values = self.values[:clip]
+      self.parent = self.parent[:clip]
+      self.left = numpy.where(self.left[:clip] < clip, self.left[:clip], -1).astype(numpy.int32)
+      self.right = numpy.where(self.right[:clip] < clip, self.right[:clip], -1).astype(numpy.int32)
+      self.depth = self.depth[:clip]
+      self._relations = None
+      self._relation_mask = None
+
+  def fold_up(self, f, leaf=None):
+    acc = [leaf] * self.size()
+    for i in reversed(range(self.size())):
+      l, r = self.left[i], self.right[i]
+      acc[i] = f(self.values[i], acc[l] if l >= 0 else leaf, acc[r] if r >= 0 else leaf)
+    return acc[0]
+
+  def fold_up_tree(self, f, leaf=None):
+    values = [None] * self.size()
+    for i in reversed(range(self.size())):
+      l, r = self.left[i], self.right[i]
+      values[i] = f(self.values[i], values[l] if l >= 0 else leaf, values[r] if r >= 0 else leaf)
+    return self.new(ut.object_array(values))
+
+  def fold_down_tree(self, f, root=None):
+    values = [root] * self.size()
+    for i in range(1, self.size()):
+      p = self.parent[i]
+      values[i] = f(self.values[p], values[p], self.left[p] == i)
+    return self.new(ut.object_array(values))
+
+  def zip(self, other):
+    "Zips the node values of this tree with other's"
+    assert numpy.array_equal(self.left, other.left) and numpy.array_equal(self.right, other.right), \
+       "Trying to zip two trees of different shape"
+    return self.new(ut.object_array(list(zip(self.values, other.values))))
+
+  def relations(self):
+    """
+    Returns (tree_parents, ends), where tree_parents[i] is the (non-binarized) parent of node i, or -1 for the root,
+    and the descendants of node i are exactly nodes i+1 ... ends[i]-1
+    """
+    if self._relations is None:
+      self._relations = link_topology(self.topology())[4:]
+    return self._relations
+
+  def relation_mask(self):
+    "Returns the HEAD_*_ID relation of every pair of nodes, as a numpy.uint16 [size, size] matrix"
+    if self._relation_mask is None:
+      tree_parents, ends = self.relations()
+      mask = relation_masks(torch.from_numpy(tree_parents).long().unsqueeze(0),
+                            torch.from_numpy(ends).long().unsqueeze(0),
+                            torch.tensor([self.size()]))
+      self._relation_mask = mask[0].numpy().astype(numpy.uint16)
+    return self._relation_mask
+
+  def set_relation_mask(self, mask):
+    "Reuses a relation_mask() computed (and stored) earlier"
+    self._relation_mask = mask
+
 def parse_clean(fun_str, remove_parens=True):
   fun_str.rstrip('\n')
   fun_str = fun_str.strip()
@@ -193,8 +452,40 @@ def parse(fun_str, cls=Tree, clip=None):
   cleaned = parse_clean(fun_str)
   tree, end = parse_lc_rs_h(cleaned)
   if tree and end == len(cleaned):
+    if issubclass(cls, ArrayTree):
+      return cls.from_nested(tree, clip=clip)
     return maybe_clip(construct_tree(tree, cls=cls), clip)
 
+def unflatten_batch(values, topologies, cls):
+  "Batched unflatten into ArrayTrees, linking the topologies of all trees with one call to link_topology"
+  sizes = numpy.array([len(topology) for topology in topologies], dtype=numpy.int64)
+  offsets = numpy.zeros(len(sizes) + 1, dtype=numpy.int64)
+  numpy.cumsum(sizes, out=offsets[1:])
+  links = link_topology(numpy.concatenate(topologies) if len(topologies) else numpy.zeros(0, dtype=numpy.uint8), offsets)
+  trees = []
+  for v, start, end in zip(values, offsets[:-1], offsets[1:]):
+    parent, left, right, depth, tree_parents, ends = [x[start:end] for x in links]
+    trees.append(cls(as_values(v), parent, left, right, depth, relations=(tree_parents, ends)))
+  return trees
+
+def unflatten(values, topology, cls=Tree):
+  "Inverse of (tree.flatten(), tree.topology())"
+  if issubclass(cls, ArrayTree):
+    return cls.from_topology(values, topology)
+  root = None
+  stack = [] # (node, is_left) slots still waiting for their subtree
+  for v, t in zip(values, topology):
+    node = cls(v)
+    if stack:
+      parent, is_left = stack.pop()
+      if is_left: parent.l = node
+      else: parent.r = node
+    else:
+      root = node
+    if t & TOPOLOGY_RIGHT: stack.append((node, False))
+    if t & TOPOLOGY_LEFT: stack.append((node, True))
+  return root
+
 def init_tensor(*size):
   device = ut.get_device()
   if len(size) == 0:
@@ -267,14 +558,131 @@ def flatten_mask_left(tree, i, mask):
   return i
 
 
+def as_array_tree(tree):
+  return tree if isinstance(tree, ArrayTree) else ArrayTree.from_topology(tree.flatten(), tree.topology())
+
+def index_paths(trees, share_paths=True):
+  """
+  Numbers the root-to-node paths (strings of left/right steps) of all nodes in trees, one depth at a time.
+  Returns (levels, node_paths), where levels[d] = (parents, num_left) gives, for each path at depth d,
+  the index of its prefix among the paths at depth d - 1 (left steps first, then right steps),
+  and node_paths gives the global index of each node's path (trees concatenated in preorder).
+  If share_paths, nodes with the same path (in the same or different trees) share one index.
+  """
+  sizes = numpy.array([tree.size() for tree in trees])
+  starts = numpy.cumsum(sizes) - sizes
+  depth = numpy.concatenate([tree.depth for tree in trees])
+  parent = numpy.concatenate([tree.parent + start for tree, start in zip(trees, starts)])
+  is_right = numpy.concatenate([(tree.parent >= 0) & (tree.left[tree.parent] != numpy.arange(tree.size())) for tree in trees])
+  by_depth = numpy.argsort(depth, kind='stable')
+  level_ends = numpy.cumsum(numpy.bincount(depth))
+
+  node_paths = numpy.empty(len(depth), dtype=numpy.int64)
+  levels = []
+  num_paths = 0
+  num_prev = 1
+  for d in range(len(level_ends)):
+    nodes = by_depth[(level_ends[d - 1] if d else 0):level_ends[d]]
+    prefixes = node_paths[parent[nodes]] - (num_paths - num_prev) if d else numpy.zeros(len(nodes), dtype=numpy.int64)
+    keys = is_right[nodes] * num_prev + prefixes
+    if share_paths:
+      paths, inverse = numpy.unique(keys, return_inverse=True)
+    else:
+      inverse = numpy.empty(len(keys), dtype=numpy.int64)
+      order = numpy.argsort(keys, kind='stable')
+      paths = keys[order]
+      inverse[order] = numpy.arange(len(keys))
+    levels.append((paths % num_prev, int((paths < num_prev).sum())))
+    node_paths[nodes] = inverse + num_paths
+    num_paths += len(paths)
+    num_prev = len(paths)
+  return levels, node_paths
+
+def get_pos_embeddings(structs, max_len, root, mat_l, mat_r, share_paths=True):
+  """
+  Batched tree.fold_down_tree(lambda _, p, is_left: (mat_l if is_left else mat_r) @ p, root) for each tree in structs,
+  flattened and padded to [bsz, max_len, embed_dim]. A node's embedding only depends on its path from the root,
+  so each distinct path in the batch is computed once (see index_paths), one depth at a time,
+  with one matmul per depth for all left steps and one for all right steps.
+  """
+  device = root.device
+  trees = [as_array_tree(struct) for struct in structs]
+  levels, node_paths = index_paths(trees, share_paths)
+
+  prev = root.unsqueeze(0)
+  path_embs = []
+  for parents, num_left in levels:
+    if path_embs:
+      parents = torch.from_numpy(parents).to(device)
+      prev = torch.cat([prev[parents[:num_left]] @ mat_l.t(),
+                        prev[parents[num_left:]] @ mat_r.t()])
+    else:
+      prev = prev.expand(len(parents), -1)
+    path_embs.append(prev)
+
+  # gather each position's path embedding, with padding pointing at an extra row of zeros
+  embed_dim = root.size()[-1]
+  path_embs.append(torch.zeros(1, embed_dim, dtype=root.dtype, device=device))
+  path_embs = torch.cat(path_embs)
+  idxs = numpy.full(len(trees) * max_len, len(path_embs) - 1, dtype=numpy.int64)
+  offset = 0
+  for b, tree in enumerate(trees):
+    idxs[b * max_len:b * max_len + tree.size()] = node_paths[offset:offset + tree.size()]
+    offset += tree.size()
+  return path_embs[torch.from_numpy(idxs).to(device)].reshape(len(trees), max_len, embed_dim)
+
+def relation_masks(tree_parents, ends, sizes):
+  """
+  Batched equivalent of flatten_mask_left, from each sentence's tree parents and subtree ends
+  (see ArrayTree.relations), padded to [bsz, src_len] (padding values are ignored), and sizes [bsz]
+  """
+  bsz, src_len = tree_parents.size()
+  device = tree_parents.device
+  idx = torch.arange(src_len, device=device)
+  before = (idx.unsqueeze(0) < idx.unsqueeze(1)).unsqueeze(0) # [1, i, j] = j < i
+  diag = torch.eye(src_len, dtype=torch.bool, device=device).unsqueeze(0)
+  valid = idx.unsqueeze(0) < sizes.unsqueeze(1) # [bsz, src_len]
+  desc = ~before & ~diag & (idx.view(1, 1, -1) < ends.unsqueeze(2)) # [bsz, i, j] = j is a descendant of i
+  children = tree_parents.unsqueeze(1) == idx.view(1, -1, 1) # [bsz, i, j] = j is a child of i
+  siblings = (tree_parents.unsqueeze(1) == tree_parents.unsqueeze(2)) & ~diag
+
+  masks = torch.where(before, HEAD_OTHERL_ID, HEAD_OTHERR_ID).int()
+  masks = masks.masked_fill(diag, HEAD_SELF_ID)
+  masks = masks.masked_fill(desc, HEAD_DESC_ID)
+  masks.masked_fill_(desc.transpose(1, 2), HEAD_ANCE_ID)
+  masks.masked_fill_(children, HEAD_CHILD_ID)
+  masks.masked_fill_(children.transpose(1, 2), HEAD_PARENT_ID)
+  masks.masked_fill_(siblings & ~before, HEAD_SIBR_ID)
+  masks.masked_fill_(siblings & before, HEAD_SIBL_ID)
+  masks.masked_fill_(~valid.unsqueeze(1), HEAD_PAD_ID)
+  masks.masked_fill_(~valid.unsqueeze(2), HEAD_EXTRA_ID)
+  return masks
+
+def stack_relation_masks(structs, src_len):
+  "Pads and stacks the relation masks already stored in structs, like relation_masks would compute them"
+  masks = numpy.full((len(structs), src_len, src_len), HEAD_PAD_ID, dtype=numpy.int32)
+  for c, struct in enumerate(structs):
+    size = struct.size()
+    masks[c, :size, :size] = struct._relation_mask
+    masks[c, size:, :] = HEAD_EXTRA_ID
+  return torch.from_numpy(masks)
+
 def get_enc_mask(toks, structs, num_heads=1):
   bsz, src_len = toks.size()
-  masks = torch.full((bsz, src_len, src_len), HEAD_PAD_ID, dtype=torch.int, device=ut.get_device())
-  
-  for c in range(bsz):
-    size = structs[c].size()
-    flatten_mask_left(structs[c], 0, masks[c, :size, :size])
-    masks[c, size:, :] = HEAD_EXTRA_ID
+  device = ut.get_device()
+  if all(isinstance(struct, ArrayTree) and struct._relation_mask is not None for struct in structs):
+    masks = stack_relation_masks(structs, src_len).to(device)
+  else:
+    tree_parents = numpy.full((bsz, src_len), -1, dtype=numpy.int64)
+    ends = numpy.zeros((bsz, src_len), dtype=numpy.int64)
+    sizes = numpy.zeros(bsz, dtype=numpy.int64)
+    for c in range(bsz):
+      size = structs[c].size()
+      tree_parents[c, :size], ends[c, :size] = as_array_tree(structs[c]).relations()
+      sizes[c] = size
+    masks = relation_masks(torch.from_numpy(tree_parents).to(device),
+                           torch.from_numpy(ends).to(device),
+                           torch.from_numpy(sizes).to(device))
 
   if num_heads == 1: return masks#.unsqueeze(1)
   else: return masks.unsqueeze(1).expand(-1, num_heads, -1, -1).clone()
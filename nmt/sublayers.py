@@ -3,14 +3,17 @@ from torch import nn
 from torch.nn import Parameter
 import torch.nn.functional as F
 
+import nmt.all_constants as ac
+
 
 class Attention(nn.Module):
     """Multi-headed attention"""
-    def __init__(self, embed_dim, num_heads, dropout=0.):
+    def __init__(self, embed_dim, num_heads, dropout=0., backend=ac.ATT_MATH):
         super(Attention, self).__init__()
         self.embed_dim = embed_dim
         self.num_heads = num_heads
         self.dropout = dropout
+        self.fused = backend == ac.ATT_FUSED and hasattr(F, 'scaled_dot_product_attention')
         self.head_dim = embed_dim // num_heads
         self.scaling = self.head_dim ** -0.5
 
@@ -33,12 +36,19 @@ class Attention(nn.Module):
             k : bsz x trg_len x embed_dim
             v : bsz x trg_len x embed_dim
             mask : (bsz x num_heads x) src_len x trg_len
+
+        Returns the output and the attention weights (None with the fused backend)
         """
         if do_proj:
             q, k, v = self.linear_projection(q, k, v)
 
         q, k, v = self.split_heads(q, k, v)
-        output, att_weights = self.scaled_dot_attention(q, k, v, mask)
+        return self.attend(q, k, v, mask)
+
+    def attend(self, q, k, v, mask):
+        "Same as forward, but with q, k, v already projected and split into heads (see split_heads)"
+        attention = self.fused_attention if self.fused else self.scaled_dot_attention
+        output, att_weights = attention(q, k, v, mask)
         output = self.concat_heads(output)
         return self.out_proj(output), att_weights
 
@@ -58,15 +68,13 @@ class Attention(nn.Module):
 
         return q, k, v
 
-    def split_heads(self, q, k, v):
+    def split_heads(self, *tensors):
+        "Reshapes each of tensors from bsz x length x embed_dim to (bsz x num_heads) x length x head_dim"
         def _split_and_transpose(tensor):
             bsz, length, embed_dim = tensor.size()
             return tensor.reshape(bsz, length, self.num_heads, self.head_dim).transpose(1, 2).reshape(bsz * self.num_heads, -1, self.head_dim)
 
-        q = _split_and_transpose(q)
-        k = _split_and_transpose(k)
-        v = _split_and_transpose(v)
-        return q, k, v
+        return tuple(_split_and_transpose(tensor) for tensor in tensors)
 
     def scaled_dot_attention(self, q, k, v, mask):
         att_weights = torch.bmm(q, k.transpose(1, 2)) * self.scaling
@@ -87,6 +95,27 @@ class Attention(nn.Module):
 
         return torch.bmm(att_weights, v), att_weights
 
+    def fused_attention(self, q, k, v, mask):
+        "Same as scaled_dot_attention, but with F.scaled_dot_product_attention, so the weights are not returned"
+        bsz_x_num_heads, src_len, _ = q.size()
+        bsz = bsz_x_num_heads // self.num_heads
+        q, k, v = [x.reshape(bsz, self.num_heads, -1, self.head_dim) for x in (q, k, v)]
+
+        attend = None # True means attend here
+        if mask is not None and type(mask) == tuple:
+            # fold the structure bias into an additive mask
+            fmask, attend = mask
+            mask = torch.where(attend, -torch.exp(fmask), float('-inf')).to(q.dtype)
+        elif mask is not None:
+            mask = attend = torch.logical_not(mask)
+
+        # its default scale is self.scaling
+        output = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=self.dropout if self.training else 0.)
+        if attend is not None:
+            # queries that attend nowhere get NaN, as with softmax over all -inf (newer torch versions return 0 here)
+            output = output.masked_fill(~attend.any(-1, keepdim=True), float('nan'))
+        return output.reshape(bsz_x_num_heads, src_len, self.head_dim), None
+
     def concat_heads(self, output):
         bsz_x_num_heads = output.size()[0]
         return output.reshape(bsz_x_num_heads // self.num_heads, self.num_heads, -1, self.head_dim).transpose(1, 2).reshape(bsz_x_num_heads // self.num_heads, -1, self.embed_dim)
@@ -1,7 +1,10 @@
 import time
 import os
+import inspect
+import contextlib
 import numpy
 import torch
+from torch.nn.parallel import DistributedDataParallel
 
 import nmt.all_constants as ac
 import nmt.utils as ut
@@ -10,15 +13,29 @@ import nmt.configurations as configurations
 from nmt.validator import Validator
 
 
+def train_process(rank, args):
+    "Trains as data-parallel process rank of args.num_procs (the only one if args.num_procs is 1)"
+    trainer = Trainer(args, rank)
+    trainer.train()
+
+
 class Trainer(object):
     """Trainer"""
-    def __init__(self, args):
+    def __init__(self, args, rank=0):
         super(Trainer, self).__init__()
         self.config = configurations.get_config(args.proto, getattr(configurations, args.proto), args.config_overrides)
         self.num_preload = args.num_preload
         self.lr = self.config['lr']
 
-        ut.remove_files_in_dir(self.config['save_to'])
+        # With several (data-parallel) processes, each trains on its share of the batches,
+        # and only the first one logs, validates and saves checkpoints
+        self.rank, self.world_size = ut.init_distributed(rank, args.num_procs, args.dist_timeout)
+        if self.world_size > 1 and self.config['shuffle_mode'] == ac.SHUFFLE_REWRITE:
+            raise ValueError('shuffle_mode ac.SHUFFLE_REWRITE cannot be used with several training processes')
+
+        if self.rank == 0:
+            ut.remove_files_in_dir(self.config['save_to'])
+        ut.barrier()
 
         self.logger = ut.get_logger(self.config['log_file'])
 
@@ -31,7 +48,9 @@ class Trainer(object):
         self.log_nll_loss = []
         self.log_train_weights = []
         self.log_grad_norms = []
-        self.total_batches = 0 # number of batches done for the whole training
+        self.log_step_times = []
+        self.total_batches = 0 # number of optimizer steps done for the whole training
+        self.patience_exhausted = False # whether training should stop early, as of the last validation
         self.epoch_loss = 0. # total train loss for whole epoch
         self.epoch_nll_loss = 0. # total train loss for whole epoch
         self.epoch_weights = 0. # total train weights (# target words) for whole epoch
@@ -40,7 +59,16 @@ class Trainer(object):
         # get model
         device = ut.get_device()
         self.model = Model(self.config).to(device)
-        self.validator = Validator(self.config, self.model)
+        self.init_grad_buffer()
+        # the model the training batches are run through, which syncs the gradients of the processes
+        if self.world_size > 1:
+            # under fix_norm, the separate embedding scales are never used, so never get a gradient
+            find_unused = self.config['fix_norm'] and self.config['separate_embed_scales']
+            self.train_model = DistributedDataParallel(self.model, device_ids=[device] if device.type == 'cuda' else None,
+                                                       find_unused_parameters=find_unused)
+        else:
+            self.train_model = self.model
+        self.validator = Validator(self.config, self.model) if self.rank == 0 else None
 
         self.validate_freq = self.config['validate_freq']
         if self.validate_freq == 1:
@@ -48,26 +76,32 @@ class Trainer(object):
         else:
             self.logger.info(f'Evaluate every {self.validate_freq:,} ' + ('epochs' if self.config['val_per_epoch'] else 'batches'))
 
-        # Estimated number of batches per epoch
-        self.est_batches = max(self.model.data_manager.training_tok_counts) // self.config['batch_size']
+        # Estimated number of batches (optimizer steps) per epoch
+        self.est_batches = max(self.model.data_manager.training_tok_counts) // (self.config['batch_size'] * self.config['accum_steps'] * self.world_size)
         self.logger.info(f'Guessing around {self.est_batches:,} batches per epoch')
 
 
         param_count = sum([numpy.prod(p.size()) for p in self.model.parameters()])
         self.logger.info(f'Model has {int(param_count):,} parameters')
 
-        # Set up parameter-specific options
-        params = []
+        # Set up parameter-specific options, with one param group per distinct set of options,
+        # so that the optimizer can update each group's parameters together
+        groups = {}
         for p in self.model.parameters():
-            ptr = p.data_ptr()
-            d = {'params': [p]}
-            if ptr in self.model.parameter_attrs:
-                attrs = self.model.parameter_attrs[ptr]
-                for k in attrs:
-                    d[k] = attrs[k]
-            params.append(d)
-        
-        self.optimizer = torch.optim.Adam(params, lr=self.lr, betas=(self.config['beta1'], self.config['beta2']), eps=self.config['epsilon'])
+            attrs = self.model.parameter_attrs.get(p.data_ptr(), {})
+            groups.setdefault(tuple(sorted(attrs.items())), {'params': [], **attrs})['params'].append(p)
+        params = list(groups.values())
+        self.logger.info(f'Optimizing them in {len(params)} param group(s)')
+
+        # fused (on gpu) or multi-tensor (foreach) Adam, rather than a loop over the parameters,
+        # if this version of torch has them (otherwise its default implementation)
+        adam_params = inspect.signature(torch.optim.Adam).parameters
+        fused = device.type == 'cuda' and 'fused' in adam_params
+        adam_options = {}
+        if 'foreach' in adam_params: adam_options['foreach'] = not fused
+        if fused: adam_options['fused'] = True
+        self.optimizer = torch.optim.Adam(params, lr=self.lr, betas=(self.config['beta1'], self.config['beta2']), eps=self.config['epsilon'],
+                                          **adam_options)
 
     def report_epoch(self, epoch, batches):
 
@@ -93,6 +127,7 @@ class Trainer(object):
         self.log_nll_loss = []
         self.log_train_weights = []
         self.log_grad_norms = []
+        self.log_step_times = []
 
         train_smooth_perp = numpy.exp(train_smooth_perp) if train_smooth_perp < 300 else float('inf')
         self.train_smooth_perps.append(train_smooth_perp)
@@ -102,64 +137,89 @@ class Trainer(object):
         self.logger.info(f'    smooth, true perp: {float(train_smooth_perp):.2f}, {float(train_true_perp):.2f}')
 
 
-    def clip_grad_values(self):
+    def init_grad_buffer(self):
         """
-        Adapted from https://pytorch.org/docs/stable/_modules/torch/nn/utils/clip_grad.html#clip_grad_value_
-        This is the same as torch.nn.utils.clip_grad_value_, except is also sets nan gradients to 0.0
+        Makes the parameters' gradients views into one flat buffer, the struct's (positional embedding) parameters' first,
+        which backward accumulates into, so that clip_grads can sanitize them all with a few ops on the whole buffer.
+        The views must stay in place: gradients are zeroed with self.grad_buffer.zero_(), never with
+        zero_grad(set_to_none=True) or by assigning p.grad, after which backward would allocate gradients outside the buffer.
         """
-        parameters = self.model.parameters()
-        clip_value = float(self.config['grad_clamp'])
-        if isinstance(parameters, torch.Tensor):
-            parameters = [parameters]
-        for p in filter(lambda p: p.grad is not None, parameters):
-            p.grad.data.clamp_(min=-clip_value, max=clip_value)
-            p.grad.data[torch.isnan(p.grad.data)] = 0.0
+        pe_params, params = list(self.get_params(True)), list(self.get_params())
+        self.num_pe_grads = sum(p.numel() for p in pe_params)
+        self.grad_buffer = torch.zeros(self.num_pe_grads + sum(p.numel() for p in params), dtype=params[0].dtype, device=params[0].device)
+        start = 0
+        for p in pe_params + params:
+            p.grad = self.grad_buffer[start:start + p.numel()].view_as(p)
+            start += p.numel()
+        self.grad_ptrs = [(p, p.grad.data_ptr()) for p in pe_params + params]
+
+    def clip_grads(self):
+        """
+        Sanitizes the gradients in place, and returns their norm before the final clip (as a tensor, so without a sync):
+        - if grad_clamp, nan gradients are set to 0.0 and the others clamped to [-grad_clamp, +grad_clamp]
+        - if grad_clip_pe, the norm of the struct parameters' gradients is clipped to grad_clip_pe
+        - the norm of all the gradients is clipped to grad_clip (as in torch.nn.utils.clip_grad_norm_)
+        """
+        assert all(p.grad is not None and p.grad.data_ptr() == ptr for p, ptr in self.grad_ptrs), \
+            'Parameter gradients no longer alias the gradient buffer (see init_grad_buffer)'
+        grads = self.grad_buffer
+        if self.config['grad_clamp']:
+            clip_value = float(self.config['grad_clamp'])
+            grads.nan_to_num_(nan=0.0).clamp_(min=-clip_value, max=clip_value)
+        if self.config['grad_clip_pe'] and self.num_pe_grads:
+            ut.clip_norm_(grads[:self.num_pe_grads], self.config['grad_clip_pe'])
+        return ut.clip_norm_(grads, self.config['grad_clip'])
 
     def get_params(self, pe=False):
         for n, p in self.model.named_parameters():
             if (n in self.model.struct_params) == pe:
                 yield p
 
-    def run_log(self, batch, epoch, batch_data):
+    def run_log(self, batch, epoch, micro_batches):
       #with torch.autograd.detect_anomaly(): # throws exception when any forward computation produces nan
+        """Takes one optimizer step on the summed gradients of micro_batches (a list of batch_data)"""
         start = time.time()
-        _, src_toks, src_structs, trg_toks, targets = batch_data
 
-        # zero grad
-        self.optimizer.zero_grad()
-
-        # get loss
-        ret = self.model(src_toks, src_structs, trg_toks, targets, batch, epoch)
-        loss = ret['loss']
-        nll_loss = ret['nll_loss']
+        # zero grad, keeping the gradients views into self.grad_buffer (so never zero_grad(set_to_none=True))
+        self.grad_buffer.zero_()
 
+        # normalize by the whole step's target words/sentences, so the summed gradients are those of one large batch
+        num_words = sum((targets != ac.PAD_ID).sum() for *_, targets in micro_batches)
         if self.config['normalize_loss'] == ac.LOSS_TOK:
-            opt_loss = loss / (targets != ac.PAD_ID).sum()
+            loss_norm = num_words
         elif self.config['normalize_loss'] == ac.LOSS_BATCH:
-            opt_loss = loss / targets.size()[0]
+            loss_norm = sum(targets.size()[0] for *_, targets in micro_batches)
         else:
-            opt_loss = loss
+            loss_norm = 1
+        if self.world_size > 1:
+            # the gradients are averaged over the processes, so normalize by their total, times their number
+            if self.config['normalize_loss'] != ac.LOSS_NONE:
+                loss_norm = ut.all_reduce(torch.as_tensor(loss_norm, dtype=torch.float, device=num_words.device))
+            loss_norm = loss_norm / self.world_size
 
-        opt_loss.backward()
+        # get loss
+        loss = nll_loss = 0.
+        for i, (_, src_toks, src_structs, trg_toks, targets) in enumerate(micro_batches):
+            # the gradients are synced across the processes in the last micro-batch's backward pass
+            if self.world_size > 1 and i < len(micro_batches) - 1:
+                sync_context = self.train_model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+            with sync_context:
+                ret = self.train_model(src_toks, src_structs, trg_toks, targets, batch, epoch)
+                (ret['loss'] / loss_norm).backward()
+            loss += ret['loss'].detach()
+            nll_loss += ret['nll_loss'].detach()
         # clip gradient
-        if self.config['grad_clamp']: self.clip_grad_values()
-        if self.config['grad_clip_pe']:
-            pms = list(self.get_params(True))
-            if pms: torch.nn.utils.clip_grad_norm_(pms, self.config['grad_clip_pe'])
-            pms = self.get_params()
-        else:
-            pms = self.model.parameters()
-        grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.config['grad_clip']).detach()
+        grad_norm = self.clip_grads()
         
         # update
         self.adjust_lr()
+        step_start = time.time()
         self.optimizer.step()
+        self.log_step_times.append(time.time() - step_start)
 
         # update training stats
-        num_words = (targets != ac.PAD_ID).detach().sum()
-
-        loss = loss.detach()
-        nll_loss = nll_loss.detach()
         self.total_batches += 1
         self.log_train_loss.append(loss)
         self.log_nll_loss.append(nll_loss)
@@ -179,6 +239,9 @@ class Trainer(object):
                     log_nll_loss += nll
                     log_train_weights += weight
                 log_all_weights += weight
+            if self.world_size > 1:
+                totals = ut.all_reduce(torch.stack([log_train_loss, log_nll_loss, log_train_weights, log_all_weights]))
+                log_train_loss, log_nll_loss, log_train_weights, log_all_weights = totals
             #log_train_loss = sum(x for x in self.log_train_loss).item()
             #log_nll_loss = sum(x for x in self.log_nll_loss).item()
             #log_train_weights = sum(x for x in self.log_train_weights).item()
@@ -196,6 +259,8 @@ class Trainer(object):
 
             avg_grad_norm = sum(self.log_grad_norms) / len(self.log_grad_norms)
             #median_grad_norm = sorted(self.log_grad_norms)[len(self.log_grad_norms)//2]
+            # (host) time of the optimizer step, so without waiting for the gpu to finish it
+            avg_step_time = sum(self.log_step_times) / len(self.log_step_times)
 
             est_percent = int(100 * batch / self.est_batches)
             epoch_len = max(5, ut.get_num_digits(self.config['max_epochs']))
@@ -207,6 +272,7 @@ class Trainer(object):
             self.log_nll_loss = []
             self.log_train_weights = []
             self.log_grad_norms = []
+            self.log_step_times = []
             cells = [f'{epoch:{epoch_len}}',
                      f'{batch:{batch_len}}',
                      f'{est_percent:3}%',
@@ -215,7 +281,8 @@ class Trainer(object):
                      f'{acc_speed_time:#6.4g}s',
                      f'{avg_smooth_perp:#11.4g}',
                      f'{avg_true_perp:#9.4g}',
-                     f'{avg_grad_norm:#9.4g}']
+                     f'{avg_grad_norm:#9.4g}',
+                     f'{avg_step_time:#9.4g}s']
             self.logger.info('  '.join(cells))
 
     def adjust_lr(self):
@@ -261,14 +328,15 @@ class Trainer(object):
         early_stop_msg = f'No improvement for last {early_stop_msg_num} {early_stop_msg_metric}; stopping early!'
         for epoch in range(1, self.config['max_epochs'] + 1):
             batch = 0
-            for batch_data in self.model.data_manager.get_batches(mode=ac.TRAINING, num_preload=self.num_preload):
+            batches = self.model.data_manager.get_batches(mode=ac.TRAINING, num_preload=self.num_preload)
+            for micro_batches in ut.group(batches, self.config['accum_steps']):
                 if batch == 0:
                     self.logger.info(f'Begin epoch {epoch}')
                     epoch_str = ' ' * max(0, ut.get_num_digits(self.config['max_epochs']) - 5) + 'epoch'
                     batch_str = ' ' * max(0, ut.get_num_digits(self.est_batches) - 5) + 'batch'
-                    self.logger.info('  '.join([epoch_str, batch_str, 'est%', 'remaining', 'trg word/s', 's/batch', 'smooth perp', 'true perp', 'grad norm']))
+                    self.logger.info('  '.join([epoch_str, batch_str, 'est%', 'remaining', 'trg word/s', 's/batch', 'smooth perp', 'true perp', 'grad norm', 'opt s/step']))
                 batch += 1
-                self.run_log(batch, epoch, batch_data)
+                self.run_log(batch, epoch, micro_batches)
                 if not self.config['val_per_epoch']:
                     stop_early = self.maybe_validate()
                     if stop_early:
@@ -287,6 +355,9 @@ class Trainer(object):
             # validate 1 last time
             self.maybe_validate(just_validate=True)
 
+        if self.rank != 0:
+            return
+
         self.logger.info('Training finished')
         self.logger.info('Train smooth perps:')
         self.logger.info(', '.join([f'{x:.2f}' for x in self.train_smooth_perps]))
@@ -329,33 +400,46 @@ class Trainer(object):
         return patience and len(curve) > patience and curve[-1 if if_worst else -1-patience] == best_worse(curve[-1-patience:])
 
     def maybe_validate(self, just_validate=False):
+        """Validates (in the first process) if it is time to, and returns whether training should stop early"""
         if self.total_batches % self.validate_freq == 0 or just_validate:
-            self.model.save()
-            self.validator.validate_and_save()
-
-            # if doing annealing
-            step = self.total_batches + 1.0
-            warmup_steps = self.config['warmup_steps']
-
-            if self.config['warmup_style'] == ac.NO_WARMUP \
-               or (self.config['warmup_style'] == ac.UPFLAT_WARMUP and step >= warmup_steps) \
-               and self.config['lr_decay'] > 0:
-
-                if self.is_patience_exhausted(self.config['lr_decay_patience'], if_worst=True):
-                    if self.config['val_by_bleu']:
-                        metric = 'bleu'
-                        scores = self.validator.bleu_curve
-                    else:
-                        metric = 'perp'
-                        scores = self.validator.perp_curve
-                    scores = ', '.join([str(x) for x in scores[-1 - self.config['lr_decay_patience']:]])
-
-                    self.logger.info(f'Past {metric} scores are {scores}')
-                    # when don't use warmup, decay lr if dev not improve
-                    if self.lr * self.config['lr_decay'] >= self.config['min_lr']:
-                        new_lr = self.lr * self.config['lr_decay']
-                        self.logger.info(f'Anneal the learning rate from {self.lr} to {new_lr}')
-                        self.lr = new_lr
-                        for p in self.optimizer.param_groups:
-                            p['lr'] = self.lr
-        return self.is_patience_exhausted(self.config['early_stop_patience'])
+            if self.rank == 0:
+                self.validate()
+                self.patience_exhausted = self.is_patience_exhausted(self.config['early_stop_patience'])
+            if self.world_size > 1:
+                # the other processes follow the first one's learning rate annealing and early stopping
+                lr, self.patience_exhausted = ut.broadcast_object((self.lr, self.patience_exhausted))
+                if lr != self.lr:
+                    self.lr = lr
+                    for p in self.optimizer.param_groups:
+                        p['lr'] = self.lr
+        return self.patience_exhausted
+
+    def validate(self):
+        self.model.save()
+        self.validator.validate_and_save()
+
+        # if doing annealing
+        step = self.total_batches + 1.0
+        warmup_steps = self.config['warmup_steps']
+
+        if self.config['warmup_style'] == ac.NO_WARMUP \
+           or (self.config['warmup_style'] == ac.UPFLAT_WARMUP and step >= warmup_steps) \
+           and self.config['lr_decay'] > 0:
+
+            if self.is_patience_exhausted(self.config['lr_decay_patience'], if_worst=True):
+                if self.config['val_by_bleu']:
+                    metric = 'bleu'
+                    scores = self.validator.bleu_curve
+                else:
+                    metric = 'perp'
+                    scores = self.validator.perp_curve
+                scores = ', '.join([str(x) for x in scores[-1 - self.config['lr_decay_patience']:]])
+
+                self.logger.info(f'Past {metric} scores are {scores}')
+                # when don't use warmup, decay lr if dev not improve
+                if self.lr * self.config['lr_decay'] >= self.config['min_lr']:
+                    new_lr = self.lr * self.config['lr_decay']
+                    self.logger.info(f'Anneal the learning rate from {self.lr} to {new_lr}')
+                    self.lr = new_lr
+                    for p in self.optimizer.param_groups:
+                        p['lr'] = self.lr
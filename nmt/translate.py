@@ -15,6 +15,8 @@ class Translator(object):
     def __init__(self, args):
         super(Translator, self).__init__()
         self.config = configurations.get_config(args.proto, getattr(configurations, args.proto), args.config_overrides)
+        if args.decode_mode:
+            self.config['decode_mode'] = {'beam': ac.BEAM_DECODE, 'greedy': ac.GREEDY_DECODE, 'sample': ac.SAMPLE_DECODE}[args.decode_mode]
         self.logger = ut.get_logger(self.config['log_file'])
         self.num_preload = args.num_preload
 
@@ -1,7 +1,9 @@
 import os
 import logging
+import datetime
 import numpy
 import torch
+import torch.distributed as dist
 import random
 
 import nmt.all_constants as ac
@@ -49,7 +51,8 @@ def get_logger(logfile='./DEBUG.log'):
     logging.logThreads = 0
     logging.logProcesses = 0
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
+    # with several training processes, only the first one logs (besides warnings)
+    logger.setLevel(logging.DEBUG if get_rank() == 0 else logging.WARNING)
     formatter = logging.Formatter(
         '%(asctime)s %(filename)16s:%(lineno)4s | %(message)s')
 
@@ -85,14 +88,35 @@ def shuffle_parallel(*arrays):
     randomized_indices = shuffle_indices(len(arrays[0]))
     return tuple(reorder(array, randomized_indices) for array in arrays)
 
+def group(xs, n):
+    'Yields the elements of iterable xs in lists of n (the last one may be shorter)'
+    chunk = []
+    for x in xs:
+        chunk.append(x)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def object_array(xs):
+    'Returns a 1-d numpy.ndarray of the elements of xs, even if they are equal-length sequences'
+    array = numpy.empty(len(xs), dtype=object)
+    for i, x in enumerate(xs):
+        array[i] = x
+    return array
+
+def pad_sequences(flat, lengths, pad_id, width=None, dtype=numpy.int32):
+    'Returns the sequences concatenated in flat (with the given lengths) as the rows of a [len(lengths), width] array padded with pad_id'
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    width = int(lengths.max(initial=0)) if width is None else width
+    padded = numpy.full([len(lengths), width], pad_id, dtype=dtype)
+    rows = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    cols = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    padded[rows, cols] = flat
+    return padded
 
-def shuffle_file(input_file):
-    with open(input_file, 'r') as fh:
-        data = [(random.random(), line) for line in fh]
-    data.sort()
-    with open(input_file, 'w') as fh:
-        for _, line in data:
-            fh.write(line)
 
 def format_time(secs):
     "Formats secs as a nice, human-readable time (in hrs, mins, secs, ms when significant)"
@@ -144,14 +168,107 @@ def normalize(x, scale=True):
     return (x - mean) / std
 
 
+def clip_norm_(x, max_norm):
+    "Scales tensor x in place to a norm of at most max_norm (as torch.nn.utils.clip_grad_norm_ does), and returns its norm before"
+    norm = x.norm()
+    x.mul_((max_norm / (norm + 1e-6)).clamp(max=1.0))
+    return norm
+
 def gnmt_length_model(alpha):
     def f(time_step, prob):
         return prob / ((5.0 + time_step + 1.0) ** alpha / 6.0 ** alpha)
     return f
 
+def greedy_choice(logprobs):
+    "Returns the most probable word of each row of logprobs [bsz, V]"
+    return logprobs.argmax(dim=-1)
+
+def sample_choice(top_k=0, top_p=1.0, temperature=1.0):
+    """
+    Returns a function sampling a word from each row of logprobs [bsz, V], optionally restricted by top_k and/or top_p (nucleus).
+    At temperature 0, sampling becomes greedy_choice.
+    """
+    if temperature < 0:
+        raise ValueError('sample_temperature must not be negative')
+    if temperature == 0:
+        return greedy_choice
+    def f(logprobs):
+        logits = logprobs / temperature
+        if top_k:
+            kth_best = torch.topk(logits, min(top_k, logits.size()[-1]), dim=-1)[0][:, -1:]
+            logits = logits.masked_fill(logits < kth_best, float('-inf'))
+        if top_p < 1.0:
+            sorted_logits, sorted_idxs = torch.sort(logits, dim=-1, descending=True)
+            sorted_probs = torch.softmax(sorted_logits, dim=-1)
+            # drop the words whose more probable words already reach top_p (so the best word is always kept)
+            drop = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+            logits = logits.scatter(-1, sorted_idxs, sorted_logits.masked_fill(drop, float('-inf')))
+        return torch.multinomial(torch.softmax(logits, dim=-1), 1).squeeze(1)
+    return f
+
 def get_device():
-    "Returns cuda:0 if available, or otherwise cpu"
-    return torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    "Returns this process's gpu if available (cuda:0, or cuda:<local rank> with several training processes), or otherwise cpu"
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+    local_rank = int(os.environ.get('LOCAL_RANK', get_rank())) # set by torchrun, which may span several machines
+    return torch.device('cuda', local_rank % torch.cuda.device_count())
+
+def autocast(enabled=True):
+    "Context running the ops in it in bfloat16 where torch.autocast deems it safe (if not enabled, in fp32)"
+    return torch.autocast(device_type=get_device().type, dtype=torch.bfloat16, enabled=enabled)
+
+def min_value(x):
+    "The most negative finite value of tensor x's dtype (a mask value that does not overflow it)"
+    return torch.finfo(x.dtype).min
+
+def init_distributed(rank=0, num_procs=1, timeout=180):
+    """
+    Joins the gloo process group of the data-parallel training processes, as process rank of num_procs
+    on this machine, or as set up by torchrun's environment variables (possibly across machines) if present.
+    Collective operations (e.g. barrier) fail after waiting timeout minutes for the other processes.
+    Returns this process's rank and the number of processes (0 and 1 when training in a single process).
+    """
+    timeout = datetime.timedelta(minutes=timeout)
+    if 'WORLD_SIZE' in os.environ:
+        dist.init_process_group('gloo', timeout=timeout)
+    elif num_procs > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        dist.init_process_group('gloo', rank=rank, world_size=num_procs, timeout=timeout)
+    else:
+        return 0, 1
+    if torch.cuda.is_available():
+        torch.cuda.set_device(get_device())
+    # the processes' dropout differs (their parameters are made the same by DistributedDataParallel)
+    torch.manual_seed(ac.SEED + dist.get_rank())
+    return dist.get_rank(), dist.get_world_size()
+
+def get_rank():
+    "Returns this process's rank among the data-parallel training processes (0 if not distributed)"
+    return dist.get_rank() if dist.is_initialized() else 0
+
+def get_world_size():
+    "Returns the number of data-parallel training processes (1 if not distributed)"
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+def barrier():
+    "Waits for all the data-parallel training processes (if any) to get here"
+    if dist.is_initialized():
+        dist.barrier()
+
+def all_reduce(x):
+    "Sums tensor x over the data-parallel training processes (if any), in place, and returns it"
+    if dist.is_initialized():
+        dist.all_reduce(x)
+    return x
+
+def broadcast_object(x):
+    "Returns the first training process's x (a picklable object) in every data-parallel training process"
+    if dist.is_initialized():
+        xs = [x]
+        dist.broadcast_object_list(xs, src=0)
+        x = xs[0]
+    return x
 
 def get_float_type():
     "Chooses between torch.cuda.FloatTensor and torch.FloatTensor"
@@ -45,7 +45,7 @@ for model in models:
     params = None
     struct = cnfg['struct']
     tree = struct.parse(sample)
-    if structs.tree_utils.Tree in tree.__class__.__bases__:
+    if isinstance(tree, (structs.tree_utils.Tree, structs.tree_utils.ArrayTree)):
         if exists(fp):
           params = struct.get_params(cnfg) if hasattr(struct, "get_params") else {}
           m = torch.load(fp, map_location='cuda:0' if torch.cuda.is_available() else 'cpu')['model']
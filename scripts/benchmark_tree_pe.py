@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Benchmarks tree positional embeddings on a parsed corpus:
+# per-sentence fold_down_tree vs. level-parallel, with and without sharing paths across the batch.
+# Usage, e.g. from the repository root:
+#   python3 scripts/benchmark_tree_pe.py nmt/data/en2vi_tree/train.en --struct tree17a2
+import argparse
+import importlib
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import nmt.structs.tree_utils as tree_utils
+
+
+def read_batches(fp, struct, batch_size, clip):
+    with open(fp, 'r') as f:
+        trees = [struct.parse(line.strip(), clip=clip).forget() for line in f if line.strip()]
+    return [trees[i:i + batch_size] for i in range(0, len(trees), batch_size)]
+
+
+def path_stats(batches):
+    "Returns (number of nodes, number of distinct root-to-node paths summed over batches)"
+    num_nodes = num_paths = 0
+    for batch in batches:
+        _, node_paths = tree_utils.index_paths([tree_utils.as_array_tree(tree) for tree in batch])
+        num_nodes += len(node_paths)
+        num_paths += int(node_paths.max()) + 1
+    return num_nodes, num_paths
+
+
+def time_pe(batches, f, backward, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        for batch in batches:
+            pe = f(batch, max(tree.size() for tree in batch))
+            if backward: pe.sum().backward()
+        best = min(best, time.time() - start)
+    return best
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    struct = importlib.import_module(f'nmt.structs.{args.struct}')
+    params = struct.get_params({'embed_dim': args.embed_dim, 'num_enc_heads': 8})
+    params = {name: x.requires_grad_() for name, x in params.items()}
+    batches = read_batches(args.input, struct, args.batch_size, args.clip)
+
+    num_nodes, num_paths = path_stats(batches)
+    print(f'{sum(map(len, batches))} sentences, {num_nodes} nodes, {num_paths} distinct paths per batch '
+          f'(unique-path ratio {num_paths / num_nodes:.3f})')
+
+    def per_sentence(batch, max_len):
+        pe = [torch.stack(list(tree.get_pos_embedding(args.embed_dim, **params).flatten())) for tree in batch]
+        return torch.nn.utils.rnn.pad_sequence(pe, batch_first=True)
+    def per_level(batch, max_len, share_paths=False):
+        mat_l, mat_r = params['c_l'] * params['mu_l'], params['c_r'] * params['mu_r']
+        return tree_utils.get_pos_embeddings(batch, max_len, params['lam'], mat_l, mat_r, share_paths=share_paths)
+    def per_path(batch, max_len):
+        return per_level(batch, max_len, share_paths=True)
+
+    methods = [('level-parallel', per_level), ('shared paths', per_path)]
+    if not args.skip_per_sentence:
+        methods.insert(0, ('per-sentence', per_sentence))
+    times = [(name, time_pe(batches, f, args.backward, args.repeat)) for name, f in methods]
+    for name, t in times:
+        print(f'{name:>16}: {t:.3f}s ({times[0][1] / t:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks tree positional embeddings on a parsed source file')
+    parser.add_argument('input', help='parsed source sentences, one tree per line')
+    parser.add_argument('--struct', default='tree17a2', help='struct module in nmt.structs (default: tree17a2)')
+    parser.add_argument('--embed-dim', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=64, help='sentences per batch')
+    parser.add_argument('--clip', type=int, default=None, help='clip trees to this many nodes')
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of this many runs')
+    parser.add_argument('--backward', action='store_true', help='also time the backward pass')
+    parser.add_argument('--skip-per-sentence', action='store_true', help='skip the slow per-sentence reference')
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
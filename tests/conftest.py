@@ -0,0 +1,64 @@
+import random
+import pytest
+import torch
+
+import nmt.configurations as cf
+import nmt.structs as struct
+from nmt.model import Model
+
+
+def random_nested(num_nodes, rng):
+    "Returns a random tree of num_nodes words, as the nested lists returned by tree_utils.parse_lc_rs_h"
+    if num_nodes == 1:
+        return f'w{rng.randrange(20)}'
+    children = []
+    left = num_nodes - 1
+    while left > 0:
+        size = rng.randint(1, left)
+        children.append(random_nested(size, rng))
+        left -= size
+    return [f'w{rng.randrange(20)}'] + children
+
+
+def to_string(nested):
+    "Formats nested lists from random_nested as a parseable tree string"
+    if isinstance(nested, str):
+        return nested
+    return '(' + ' '.join(to_string(x) for x in nested) + ')'
+
+
+@pytest.fixture
+def rng():
+    return random.Random(0)
+
+
+@pytest.fixture
+def tiny_config(tmp_path):
+    "Returns a function building the config of a tiny model, over a tiny tree-structured corpus in tmp_path"
+    rng = random.Random(0)
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    for mode, num_lines in [('train', 40), ('dev', 4), ('test', 4)]:
+        with open(data_dir / f'{mode}.src', 'w') as src_f, open(data_dir / f'{mode}.trg', 'w') as trg_f:
+            for _ in range(num_lines):
+                nested = random_nested(rng.randint(2, 10), rng)
+                src_f.write(to_string(nested) + '\n')
+                trg_f.write(to_string(nested).replace('(', '').replace(')', '').upper() + '\n')
+
+    def make_config(**overrides):
+        options = dict(data_dir=str(data_dir), save_to=str(tmp_path / 'save'), src_lang='src', trg_lang='trg',
+                       struct=struct.tree17a2, embed_dim=16, ff_dim=32, num_enc_layers=1, num_dec_layers=1,
+                       num_enc_heads=2, num_dec_heads=2, batch_size=200)
+        options.update(overrides)
+        config = cf.base_config.adapt(**options).compute()
+        config['model_name'] = 'tiny'
+        return config
+    return make_config
+
+
+@pytest.fixture
+def tiny_model(tiny_config):
+    def make_model(**overrides):
+        torch.manual_seed(0)
+        return Model(tiny_config(**overrides))
+    return make_model
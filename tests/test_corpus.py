@@ -0,0 +1,76 @@
+import numpy
+
+from nmt.corpus import Corpus, CorpusWriter, encode_rows, reorder_offsets
+
+
+def write_corpus(prefix, rng, num_lines=50, with_masks=True):
+    "Writes random sentence pairs to a Corpus at prefix, returning them as a list of (src, topology, trg, mask)"
+    lines = []
+    with CorpusWriter(prefix) as writer:
+        for _ in range(num_lines):
+            size = rng.randint(1, 12)
+            src = rng.randint(0, 1000, size=size)
+            topology = rng.randint(0, 4, size=size).astype(numpy.uint8)
+            trg = rng.randint(0, 1000, size=rng.randint(1, 12))
+            mask = rng.randint(0, 3, size=(size, size)).astype(numpy.uint16) if with_masks else None
+            writer.write(src, topology, trg, mask)
+            lines.append((src, topology, trg, mask))
+    assert writer.num_lines == num_lines
+    return lines
+
+
+def check_read(corpus, lines, idxs):
+    src_toks, src_topology, trg_toks, src_masks = corpus.read(idxs)
+    assert len(src_toks) == len(idxs)
+    for i, src, topology, trg, mask in zip(idxs, src_toks, src_topology, trg_toks, src_masks):
+        expected = lines[i]
+        assert numpy.array_equal(src, expected[0])
+        assert numpy.array_equal(topology, expected[1])
+        assert numpy.array_equal(trg, expected[2])
+        if expected[3] is None:
+            assert mask is None
+        else:
+            assert numpy.array_equal(mask, expected[3])
+
+
+def test_round_trip(tmp_path):
+    rng = numpy.random.RandomState(0)
+    for with_masks in [True, False]:
+        prefix = str(tmp_path / f'corpus{with_masks}')
+        lines = write_corpus(prefix, rng, with_masks=with_masks)
+        corpus = Corpus(prefix)
+        assert len(corpus) == len(lines)
+        assert numpy.array_equal(corpus.src_lengths(), [len(line[0]) for line in lines])
+        assert numpy.array_equal(corpus.trg_lengths(), [len(line[2]) for line in lines])
+        check_read(corpus, lines, numpy.arange(len(lines)))
+        check_read(corpus, lines, rng.permutation(len(lines))[:20])
+
+
+def test_shuffle_keeps_pairs(tmp_path):
+    rng = numpy.random.RandomState(0)
+    prefix = str(tmp_path / 'corpus')
+    lines = write_corpus(prefix, rng)
+    corpus = Corpus(prefix)
+    corpus.shuffle(chunk_size=7)
+    src_toks, src_topology, trg_toks, src_masks = corpus.read(numpy.arange(len(corpus)))
+    key = lambda src, trg: (tuple(src), tuple(trg))
+    expected = {key(src, trg): (topology, mask) for src, topology, trg, mask in lines}
+    assert sorted(key(src, trg) for src, trg in zip(src_toks, trg_toks)) == sorted(expected)
+    for src, topology, trg, mask in zip(src_toks, src_topology, trg_toks, src_masks):
+        assert numpy.array_equal(topology, expected[key(src, trg)][0])
+        assert numpy.array_equal(mask, expected[key(src, trg)][1])
+
+
+def test_encode_rows():
+    matrix = numpy.array([[1, 1, 2], [2, 2, 2], [3, 1, 1]], dtype=numpy.uint16)
+    values, lengths = encode_rows(matrix)
+    assert list(values) == [1, 2, 2, 3, 1]
+    assert list(lengths) == [2, 1, 3, 1, 2]
+    assert numpy.array_equal(numpy.repeat(values, lengths).reshape(3, 3), matrix)
+
+
+def test_reorder_offsets():
+    offsets = numpy.array([0, 2, 5, 6])
+    new_offsets, idxs = reorder_offsets(offsets, numpy.array([2, 0, 1]))
+    assert list(new_offsets) == [0, 1, 3, 6]
+    assert list(idxs) == [5, 0, 1, 2, 3, 4]
@@ -0,0 +1,82 @@
+from collections import Counter
+import numpy
+
+import nmt.all_constants as ac
+import nmt.utils as ut
+from nmt.corpus import Corpus, CorpusWriter
+from nmt.data_manager import DataManager
+
+
+def epoch_batches(config):
+    numpy.random.seed(ac.SEED)
+    data_manager = DataManager(config)
+    return [tuple(x.cpu().numpy() for x in (src, trg, targets))
+            for _, src, _, trg, targets in data_manager.get_batches(ac.TRAINING, num_preload=10)]
+
+
+def test_batches_independent_of_workers(tiny_config):
+    expected = epoch_batches(tiny_config(word_dropout=0.3, num_data_workers=0))
+    assert len(expected) > 1
+    for num_data_workers, tensor_prefetch in [(0, 0), (2, 2)]:
+        batches = epoch_batches(tiny_config(word_dropout=0.3, num_data_workers=num_data_workers, tensor_prefetch=tensor_prefetch))
+        assert len(batches) == len(expected)
+        for batch, expected_batch in zip(batches, expected):
+            for x, y in zip(batch, expected_batch):
+                assert numpy.array_equal(x, y)
+
+
+def test_shortlist_table_counts_pairs(tiny_config):
+    data_manager = DataManager(tiny_config(shortlist_size=3))
+    table = data_manager.shortlist_table.cpu().numpy()
+    data_manager.create_shortlist_table(chunk_size=7)
+    assert numpy.array_equal(data_manager.shortlist_table.cpu().numpy(), table)
+
+    counts = {}
+    src_toks, _, trg_toks, _ = Corpus(data_manager.corpus_files[ac.TRAINING]).read(numpy.arange(40))
+    for src, trg in zip(src_toks, trg_toks):
+        for s in src[src >= len(ac._START_VOCAB)]:
+            for t in trg[trg >= len(ac._START_VOCAB)]:
+                counts.setdefault(s, Counter())[t] += 1
+    for s, row in enumerate(table):
+        expected = sorted(counts.get(s, {}).items(), key=lambda x: (-x[1], x[0]))[:3]
+        assert list(row[:len(expected)]) == [t for t, _ in expected]
+        assert (row[len(expected):] == ac.PAD_ID).all()
+
+
+def test_shard_windows_splits_batches_evenly(tiny_config, monkeypatch):
+    data_manager = DataManager(tiny_config(), init_vocab=False)
+    windows, start = [], 0
+    for num_batches in [5, 7, 1, 10]:
+        windows.append([numpy.arange(start + i * 3, start + i * 3 + 3) for i in range(num_batches)])
+        start += num_batches * 3
+    assert data_manager.shard_windows(windows) is windows
+    for world_size in [2, 3, 4]:
+        monkeypatch.setattr(ut, 'get_world_size', lambda: world_size)
+        shards = []
+        for rank in range(world_size):
+            monkeypatch.setattr(ut, 'get_rank', lambda: rank)
+            shards.append(data_manager.shard_windows(windows))
+        # the same number of batches for every process, each batch in at most one of them
+        assert [sum(map(len, shard)) for shard in shards] == [23 // world_size] * world_size
+        assert all(batches for shard in shards for batches in shard)
+        sentences = numpy.concatenate([batch for shard in shards for batches in shard for batch in batches])
+        assert len(numpy.unique(sentences)) == len(sentences) == 23 // world_size * world_size * 3
+
+
+def test_plan_batches_covers_corpus_within_budget(tiny_config, tmp_path):
+    rng = numpy.random.RandomState(0)
+    prefix = str(tmp_path / 'corpus')
+    with CorpusWriter(prefix) as writer:
+        for _ in range(300):
+            src_len = rng.randint(1, 30)
+            writer.write(rng.randint(0, 100, size=src_len), numpy.zeros(src_len, dtype=numpy.uint8), rng.randint(0, 100, size=rng.randint(1, 30)))
+    corpus = Corpus(prefix)
+    src_lengths, trg_lengths = corpus.src_lengths(), corpus.trg_lengths()
+    for bucket_batches in [True, False]:
+        data_manager = DataManager(tiny_config(batch_size=60, bucket_batches=bucket_batches), init_vocab=False)
+        windows = data_manager.plan_batches(corpus, rng.permutation(len(corpus)), num_preload=50)
+        batches = [batch for window in windows for batch in window]
+        assert numpy.array_equal(numpy.sort(numpy.concatenate(batches)), numpy.arange(len(corpus)))
+        for batch in batches:
+            assert len(batch) == 1 or len(batch) * max(src_lengths[batch].max(), trg_lengths[batch].max()) <= 60
+        assert all(sum(map(len, window)) <= 50 + max(map(len, window)) for window in windows)
@@ -0,0 +1,236 @@
+import functools
+import torch
+
+import nmt.all_constants as ac
+import nmt.utils as ut
+
+
+def decode_batch(model):
+    "Returns the (src_toks, src_structs) of the first validation batch"
+    _, src, structs, _, _ = next(iter(model.data_manager.get_batches(ac.VALIDATING)))
+    return src, structs
+
+
+def bias_eos(model, monkeypatch, eos_bias):
+    "Adds eos_bias to the logit of eos, so that an untrained model ends its translations at various lengths"
+    logit_fn = model.logit_fn
+    monkeypatch.setattr(model, 'logit_fn', lambda *args: logit_fn(*args) + eos_bias * (torch.arange(len(model.trg_vocab_mask)) == ac.EOS_ID))
+
+
+def redecode_fn(decoder, encoder_out, encoder_mask, get_input_fn, logprob_fn, bos_id):
+    "Returns a function giving the next word log-probs [n, V] of sentence b's hypotheses [n, t], decoded from scratch"
+    def next_logprobs(b, hyps):
+        ids = torch.tensor([[bos_id] + hyp for hyp in hyps])
+        inputs = torch.cat([get_input_fn(ids[:, j:j + 1], j) for j in range(ids.size()[1])], 1)
+        mask = torch.triu(torch.ones((1, 1, ids.size()[1], ids.size()[1]), dtype=torch.bool), diagonal=1)
+        outputs = decoder(inputs, mask, encoder_out[b:b + 1].expand(len(hyps), -1, -1), encoder_mask[b:b + 1].expand(len(hyps), -1, -1, -1))
+        return logprob_fn(outputs[:, -1])
+    return next_logprobs
+
+
+def reference_beam_decode(decoder, encoder_out, encoder_mask, get_input_fn, logprob_fn, length_fn, bos_id, eos_id, max_len, beam_size=4):
+    "Decoder.beam_decode as it was before the decoding cache: one sentence at a time, re-decoding every hypothesis at each step"
+    batch_size = encoder_out.size()[0]
+    maximum_length = max_len.max().item()
+    next_logprobs = redecode_fn(decoder, encoder_out, encoder_mask, get_input_fn, logprob_fn, bos_id)
+    ret = {
+        'symbols': torch.full((batch_size, beam_size, maximum_length), eos_id, dtype=torch.long),
+        'probs': torch.zeros(batch_size, beam_size),
+        'scores': torch.zeros(batch_size, beam_size)
+    }
+    for b in range(batch_size):
+        probs = next_logprobs(b, [[]])[0]
+        probs[eos_id] = float('-inf')
+        last_probs, symbols = torch.topk(probs, beam_size)
+        last_scores = last_probs.clone()
+        hyps = [[symbol] for symbol in symbols.tolist()]
+        for time_step in range(1, maximum_length):
+            if max_len[b] < time_step or all(hyp[-1] == eos_id for hyp in hyps):
+                break
+            probs = next_logprobs(b, hyps)
+            num_classes = probs.size()[-1]
+            finished = torch.tensor([hyp[-1] == eos_id for hyp in hyps]).unsqueeze(1)
+            not_eos = torch.arange(num_classes) != eos_id
+            beam_probs = torch.where(finished, last_probs.unsqueeze(1).expand(-1, num_classes).masked_fill(not_eos, float('-inf')),
+                                     last_probs.unsqueeze(1) + probs)
+            beam_scores = torch.where(finished, last_scores.unsqueeze(1).expand(-1, num_classes).masked_fill(not_eos, float('-inf')),
+                                      length_fn(time_step, beam_probs))
+            last_scores, idxs = torch.topk(beam_scores.reshape(-1), beam_size)
+            last_probs = beam_probs.reshape(-1)[idxs]
+            hyps = [hyps[i // num_classes] + [i % num_classes] for i in idxs.tolist()]
+        ret['symbols'][b, :, :len(hyps[0])] = torch.tensor(hyps)
+        ret['probs'][b] = last_probs
+        ret['scores'][b] = last_scores
+    return ret
+
+
+def reference_pruned_decode(decoder, encoder_out, encoder_mask, get_input_fn, logprob_fn, length_fn, bos_id, eos_id, max_len, beam_size=4):
+    """
+    Decoder.pruned_beam_decode without its early stop: each sentence is decoded to its length limit,
+    and its best translation is returned (in a beam of 1)
+    """
+    batch_size = encoder_out.size()[0]
+    maximum_length = max_len.max().item()
+    next_logprobs = redecode_fn(decoder, encoder_out, encoder_mask, get_input_fn, logprob_fn, bos_id)
+    ret = {
+        'symbols': torch.full((batch_size, 1, maximum_length), eos_id, dtype=torch.long),
+        'probs': torch.zeros(batch_size, 1),
+        'scores': torch.zeros(batch_size, 1)
+    }
+    for b in range(batch_size):
+        probs = next_logprobs(b, [[]])[0]
+        probs[eos_id] = float('-inf')
+        last_probs, symbols = torch.topk(probs, beam_size)
+        hyps = [[symbol] for symbol in symbols.tolist()]
+        finished = [] # (score, prob, hyp)
+        for time_step in range(1, maximum_length + 1):
+            if max_len[b] < time_step or time_step == maximum_length:
+                finished += zip(length_fn(time_step - 1, last_probs).tolist(), last_probs.tolist(), hyps)
+                break
+            probs = next_logprobs(b, hyps)
+            num_classes = probs.size()[-1]
+            beam_probs = (last_probs.unsqueeze(1) + probs).reshape(-1)
+            cand_scores, cand_idxs = torch.topk(length_fn(time_step, beam_probs), 2 * beam_size)
+            cands = [(score, beam_probs[i].item(), hyps[i // num_classes] + [i % num_classes])
+                     for score, i in zip(cand_scores.tolist(), cand_idxs.tolist())]
+            finished += [cand for cand in cands[:beam_size] if cand[2][-1] == eos_id]
+            live = [cand for cand in cands if cand[2][-1] != eos_id][:beam_size]
+            last_probs = torch.tensor([prob for _, prob, _ in live])
+            hyps = [hyp for _, _, hyp in live]
+        score, prob, hyp = max(finished, key=lambda x: x[0])
+        ret['symbols'][b, 0, :len(hyp)] = torch.tensor(hyp)
+        ret['probs'][b] = prob
+        ret['scores'][b] = score
+    return ret
+
+
+def check_same_translations(ret, expected):
+    assert torch.equal(ret['symbols'], expected['symbols'])
+    assert torch.allclose(ret['probs'], expected['probs'], atol=1e-5)
+    assert torch.allclose(ret['scores'], expected['scores'], atol=1e-5)
+
+
+def test_beam_decode_matches_redecoding(tiny_model, monkeypatch):
+    for length_model in [ac.GNMT_LENGTH_MODEL, ac.NO_LENGTH_MODEL]:
+        model = tiny_model(max_trg_length=12, length_model=length_model)
+        model.eval()
+        src, structs = decode_batch(model)
+        with torch.no_grad():
+            ret = model.decode(src, structs)
+            with monkeypatch.context() as m:
+                m.setattr(model.decoder, 'beam_decode', functools.partial(reference_beam_decode, model.decoder))
+                expected = model.decode(src, structs)
+        check_same_translations(ret, expected)
+
+
+def test_beam_step_matches_forward(tiny_model):
+    "Decoding step by step, with each sentence's hypotheses sharing its encoder keys/values, matches decoding at once"
+    bsz, beam_size, src_len, trg_len = 3, 2, 5, 6
+    for att_backend in [ac.ATT_MATH, ac.ATT_FUSED]:
+        decoder = tiny_model(att_backend=att_backend).decoder
+        decoder.eval()
+        embed_dim = decoder.last_lnorm.normalized_shape[0]
+        encoder_out = torch.randn(bsz, src_len, embed_dim)
+        encoder_mask = (torch.arange(src_len) >= torch.tensor([5, 3, 1]).unsqueeze(1)).reshape(bsz, 1, 1, src_len)
+        inputs = torch.randn(bsz * beam_size, trg_len, embed_dim)
+        inputs[:, 0] = inputs[::beam_size, 0].repeat_interleave(beam_size, 0) # all of a sentence's hypotheses start with BOS
+        trg_mask = torch.triu(torch.ones((1, 1, trg_len, trg_len), dtype=torch.bool), diagonal=1)
+        with torch.no_grad():
+            expected = decoder(inputs, trg_mask, encoder_out.repeat_interleave(beam_size, 0), encoder_mask.repeat_interleave(beam_size, 0))
+            cache = decoder.init_cache(encoder_out, encoder_mask, trg_len, beam_size)
+            outputs = [decoder.beam_step(inputs[::beam_size, :1], cache).repeat_interleave(beam_size, 0)]
+            decoder.select_hyps(cache, torch.arange(bsz).repeat_interleave(beam_size))
+            for t in range(1, trg_len):
+                outputs.append(decoder.beam_step(inputs[:, t:t + 1], cache))
+        assert torch.allclose(torch.cat(outputs, 1), expected, atol=1e-5)
+
+
+def test_beam_decode_stores_sentences_finishing_apart(tiny_model, monkeypatch):
+    "Sentences leave the beam at different steps, and their translations are stored at their own index"
+    model = tiny_model(max_trg_length=12)
+    model.eval()
+    src, structs = decode_batch(model)
+    bias_eos(model, monkeypatch, 1.5)
+    with torch.no_grad():
+        ret = model.decode(src, structs)
+        monkeypatch.setattr(model.decoder, 'beam_decode', functools.partial(reference_beam_decode, model.decoder))
+        expected = model.decode(src, structs)
+    check_same_translations(ret, expected)
+    lengths = (ret['symbols'][:, 0] != ac.EOS_ID).sum(-1)
+    assert len(set(lengths.tolist())) > 1
+
+
+def test_greedy_decode_matches_beam_of_one(tiny_model, monkeypatch):
+    for eos_bias in [0., 1.5]:
+        model = tiny_model(max_trg_length=12, beam_size=1)
+        model.eval()
+        src, structs = decode_batch(model)
+        with monkeypatch.context() as m:
+            bias_eos(model, m, eos_bias)
+            with torch.no_grad():
+                expected = model.decode(src, structs)
+                model.config['decode_mode'] = ac.GREEDY_DECODE
+                ret = model.decode(src, structs)
+        check_same_translations(ret, expected)
+
+
+def best_translations(ret):
+    return {name: x[:, :1] for name, x in ret.items()}
+
+
+def test_pruned_beam_decode_matches_beam_decode(tiny_model, monkeypatch):
+    for length_model in [ac.GNMT_LENGTH_MODEL, ac.NO_LENGTH_MODEL]:
+        for eos_bias in [0., 1.5]:
+            model = tiny_model(max_trg_length=12, length_model=length_model)
+            model.eval()
+            src, structs = decode_batch(model)
+            with monkeypatch.context() as m:
+                bias_eos(model, m, eos_bias)
+                with torch.no_grad():
+                    expected = model.decode(src, structs)
+                    model.config['beam_prune'] = True
+                    ret = model.decode(src, structs)
+            check_same_translations(best_translations(ret), best_translations(expected))
+
+
+def synthetic_decode_args(decoder, seed, length_fn, eos_bias, vocab_size=8, bsz=16, src_len=5):
+    """
+    Returns the arguments of Decoder.beam_decode (up to beam_size) for a random batch, where the log-probs are
+    a random projection of the decoder output, so that they depend on each hypothesis' words (bos_id 0, eos_id 1)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    embed_dim = decoder.last_lnorm.normalized_shape[0]
+    word_embeds = torch.randn(vocab_size, embed_dim, generator=generator)
+    pos_embeds = torch.randn(32, embed_dim, generator=generator)
+    weight = torch.randn(embed_dim, vocab_size, generator=generator) * 0.5
+    bias = eos_bias * (torch.arange(vocab_size) == 1)
+    encoder_out = torch.randn(bsz, src_len, embed_dim, generator=generator)
+    encoder_mask = (torch.arange(src_len) >= torch.randint(1, src_len + 1, (bsz, 1), generator=generator)).reshape(bsz, 1, 1, src_len)
+    max_len = torch.randint(3, 20, (bsz,), generator=generator)
+    get_input_fn = lambda ids, time_step: word_embeds[ids] + pos_embeds[time_step]
+    logprob_fn = lambda y: torch.log_softmax(y @ weight + bias, dim=-1)
+    return encoder_out, encoder_mask, get_input_fn, logprob_fn, length_fn, 0, 1, max_len
+
+
+def test_pruned_beam_decode_stops_safely(tiny_model, monkeypatch):
+    "Stopping a sentence once no live hypothesis can outscore its best finished one does not change its best translation"
+    decoder = tiny_model().decoder
+    decoder.eval()
+    beam_step = decoder.beam_step
+    num_steps = []
+    def counted_beam_step(*args):
+        num_steps.append(1)
+        return beam_step(*args)
+    monkeypatch.setattr(decoder, 'beam_step', counted_beam_step)
+    stopped_early = []
+    # with the linear length model, later translations can outscore the first finished ones
+    for length_fn in [ut.gnmt_length_model(0.6), lambda t, p: p + t]:
+        for seed in range(3):
+            args = synthetic_decode_args(decoder, seed, length_fn, eos_bias=2.)
+            num_steps.clear()
+            with torch.no_grad():
+                ret = decoder.pruned_beam_decode(*args, beam_size=3)
+                expected = reference_pruned_decode(decoder, *args, beam_size=3)
+            check_same_translations(best_translations(ret), expected)
+            stopped_early.append(len(num_steps) < args[-1].max().item()) # the batch stopped before its longest length limit
+    assert any(stopped_early)
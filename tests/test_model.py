@@ -0,0 +1,29 @@
+import torch
+
+import nmt.all_constants as ac
+
+
+def loss_and_grads(model, batch):
+    _, src, structs, trg, targets = batch
+    model.zero_grad()
+    ret = model(src, structs, trg, targets)
+    ret['loss'].backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+    return ret['loss'].detach(), ret['nll_loss'].detach(), grads
+
+
+def test_chunked_loss_matches_unchunked(tiny_model):
+    model = tiny_model(loss_chunk_size=0, label_smoothing=0.1)
+    model.eval() # no dropout, so that every forward pass computes the same outputs
+    batch = next(iter(model.data_manager.get_batches(ac.TRAINING, num_preload=100)))
+    loss, nll_loss, grads = loss_and_grads(model, batch)
+    for chunk_size in [1, 7, 100000]:
+        model.config['loss_chunk_size'] = chunk_size
+        chunked_loss, chunked_nll_loss, chunked_grads = loss_and_grads(model, batch)
+        assert torch.allclose(chunked_loss, loss, rtol=1e-5)
+        assert torch.allclose(chunked_nll_loss, nll_loss, rtol=1e-5)
+        assert grads.keys() == chunked_grads.keys()
+        for name in grads:
+            # summation order differs, so compare within the float32 rounding of the largest gradient
+            atol = 1e-6 * max(1., grads[name].abs().max().item())
+            assert torch.allclose(chunked_grads[name], grads[name], rtol=1e-4, atol=atol), name
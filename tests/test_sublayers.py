@@ -0,0 +1,30 @@
+import torch
+
+import nmt.all_constants as ac
+from nmt.sublayers import Attention
+
+
+def random_masks(bsz, num_heads, src_len, trg_len):
+    "Returns a padding mask, a causal mask and a (fmask, bmask) structure mask, each with some rows fully masked"
+    padding = torch.arange(trg_len) >= torch.tensor([trg_len, 2, 0]).reshape(bsz, 1, 1, 1) # the last sentence is all padding
+    causal = torch.triu(torch.ones((1, 1, src_len, trg_len), dtype=torch.bool), diagonal=1)
+    causal[:, :, 0] = True # the first query sees nothing
+    bmask = torch.rand(bsz, 1, src_len, trg_len) < 0.6
+    bmask[:, :, 1] = False
+    fmask = torch.randn(bsz, num_heads, src_len, trg_len)
+    return [padding, causal, (fmask, bmask)]
+
+
+def test_fused_attention_matches_math():
+    torch.manual_seed(0)
+    bsz, num_heads, head_dim, src_len, trg_len = 3, 2, 4, 5, 7
+    math_att = Attention(num_heads * head_dim, num_heads, backend=ac.ATT_MATH)
+    fused_att = Attention(num_heads * head_dim, num_heads, backend=ac.ATT_FUSED)
+    q = torch.randn(bsz * num_heads, src_len, head_dim)
+    k = torch.randn(bsz * num_heads, trg_len, head_dim)
+    v = torch.randn(bsz * num_heads, trg_len, head_dim)
+    for mask in random_masks(bsz, num_heads, src_len, trg_len):
+        expected, _ = math_att.scaled_dot_attention(q, k, v, mask)
+        output, _ = fused_att.fused_attention(q, k, v, mask)
+        assert expected.isnan().any() # the fully masked rows
+        assert torch.allclose(output, expected, atol=1e-6, equal_nan=True)
@@ -0,0 +1,86 @@
+import socket
+import pytest
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+import nmt.all_constants as ac
+from nmt.train import Trainer
+
+
+def make_trainer(model):
+    "Returns a Trainer of model with just what init_grad_buffer and clip_grads use (the constructor also sets up data and validation)"
+    trainer = Trainer.__new__(Trainer)
+    trainer.config = model.config
+    trainer.model = model
+    trainer.init_grad_buffer()
+    return trainer
+
+
+def reference_clip_grads(model, config):
+    "Sanitizes model's gradients as Trainer did before the gradient buffer, one pass per step, returning the norm"
+    params = list(model.parameters())
+    if config['grad_clamp']:
+        for p in params:
+            p.grad.clamp_(min=-config['grad_clamp'], max=config['grad_clamp'])
+            p.grad[torch.isnan(p.grad)] = 0.0
+    if config['grad_clip_pe']:
+        pe_params = [p for n, p in model.named_parameters() if n in model.struct_params]
+        torch.nn.utils.clip_grad_norm_(pe_params, config['grad_clip_pe'])
+    return torch.nn.utils.clip_grad_norm_(params, config['grad_clip'])
+
+
+def test_clip_grads_matches_reference(tiny_model):
+    for grad_clamp, grad_clip_pe in [(0, 0), (0.5, 0), (0, 0.1), (0.5, 0.1)]:
+        trainer = make_trainer(tiny_model(learned_pos_src=True, grad_clamp=grad_clamp, grad_clip_pe=grad_clip_pe, grad_clip=2.0))
+        assert trainer.num_pe_grads > 0
+        model = tiny_model(learned_pos_src=True)
+        names = dict(model.named_parameters())
+        for name, p in trainer.model.named_parameters():
+            p.grad.copy_(torch.randn(p.size()))
+            if grad_clamp:
+                p.grad.view(-1)[::7] = float('nan')
+            names[name].grad = p.grad.clone()
+        norm = trainer.clip_grads()
+        expected_norm = reference_clip_grads(model, trainer.config)
+        assert torch.allclose(norm, expected_norm, rtol=1e-5)
+        for name, p in trainer.model.named_parameters():
+            assert torch.allclose(p.grad, names[name].grad, rtol=1e-5, atol=1e-7), name
+
+
+def check_grads_alias_buffer(trainer):
+    assert trainer.grad_buffer.abs().sum() > 0
+    assert all(p.grad.data_ptr() == ptr for p, ptr in trainer.grad_ptrs)
+    trainer.clip_grads() # checks the same
+
+
+def loss_of(model, batch):
+    _, src, structs, trg, targets = batch
+    return model(src, structs, trg, targets)['loss']
+
+
+@pytest.fixture
+def process_group():
+    "A gloo process group of this process alone"
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=0, world_size=1)
+    yield
+    dist.destroy_process_group()
+
+
+def test_grads_alias_buffer_after_backward(tiny_model, process_group):
+    trainer = make_trainer(tiny_model(learned_pos_src=True))
+    batches = list(trainer.model.data_manager.get_batches(ac.TRAINING, num_preload=100))[:2]
+    loss_of(trainer.model, batches[0]).backward()
+    check_grads_alias_buffer(trainer)
+
+    # accumulated without syncing, then synced by DistributedDataParallel
+    trainer.grad_buffer.zero_()
+    train_model = DistributedDataParallel(trainer.model)
+    with train_model.no_sync():
+        loss_of(train_model, batches[0]).backward()
+    check_grads_alias_buffer(trainer)
+    loss_of(train_model, batches[1]).backward()
+    check_grads_alias_buffer(trainer)
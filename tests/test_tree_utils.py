@@ -0,0 +1,113 @@
+import numpy
+import torch
+
+import nmt.structs.tree_utils as tree_utils
+from conftest import random_nested
+
+
+def random_trees(rng, num_trees=200, max_nodes=30):
+    "Returns pairs of the same random trees, as linked tree_utils.Trees and as ArrayTrees (some clipped)"
+    pairs = []
+    for _ in range(num_trees):
+        num_nodes = rng.randint(1, max_nodes)
+        clip = rng.randint(1, num_nodes) if rng.random() < 0.3 else None
+        tree = tree_utils.maybe_clip(tree_utils.construct_tree(random_nested(num_nodes, rng)), clip)
+        pairs.append((tree, tree_utils.ArrayTree.from_nested(random_nested_copy(tree), clip=clip)))
+    return pairs
+
+
+def random_nested_copy(tree):
+    "Converts a linked Tree back to nested lists"
+    children = []
+    child = tree.l
+    while child:
+        children.append(random_nested_copy(child))
+        child = child.r
+    return [tree.v] + children if children else tree.v
+
+
+def linked_arrays(tree):
+    "Reference (parent, left, right, depth) of a linked Tree, indexed by preorder position"
+    nodes = []
+    stack = [(tree, -1, 0)]
+    while stack:
+        node, parent, depth = stack.pop()
+        nodes.append((node, parent, depth))
+        i = len(nodes) - 1
+        if node.r: stack.append((node.r, i, depth + 1))
+        if node.l: stack.append((node.l, i, depth + 1))
+    index = {id(node): i for i, (node, _, _) in enumerate(nodes)}
+    parent = numpy.array([p for _, p, _ in nodes])
+    left = numpy.array([index[id(node.l)] if node.l else -1 for node, _, _ in nodes])
+    right = numpy.array([index[id(node.r)] if node.r else -1 for node, _, _ in nodes])
+    depth = numpy.array([d for _, _, d in nodes])
+    return parent, left, right, depth
+
+
+def test_from_topology_matches_linked_tree(rng):
+    for tree, array_tree in random_trees(rng):
+        assert list(array_tree.flatten()) == tree.flatten()
+        assert numpy.array_equal(array_tree.topology(), tree.topology())
+        parent, left, right, depth = linked_arrays(tree)
+        unflattened = tree_utils.ArrayTree.from_topology(tree.flatten(), tree.topology())
+        for t in [array_tree, unflattened]:
+            assert numpy.array_equal(t.parent, parent)
+            assert numpy.array_equal(t.left, left)
+            assert numpy.array_equal(t.right, right)
+            assert numpy.array_equal(t.depth, depth)
+        assert str(unflattened) == str(tree)
+
+
+def test_unflatten_batch_matches_unflatten(rng):
+    trees = [array_tree for _, array_tree in random_trees(rng)]
+    batch = tree_utils.unflatten_batch([t.flatten() for t in trees], [t.topology() for t in trees], cls=tree_utils.ArrayTree)
+    for t, b in zip(trees, batch):
+        single = tree_utils.unflatten(t.flatten(), t.topology(), cls=tree_utils.ArrayTree)
+        for field in ['values', 'parent', 'left', 'right', 'depth']:
+            assert numpy.array_equal(getattr(b, field), getattr(single, field))
+        for x, y in zip(b.relations(), single.relations()):
+            assert numpy.array_equal(x, y)
+
+
+def test_relation_masks_match_flatten_mask_left(rng):
+    pairs = random_trees(rng, num_trees=40, max_nodes=15)
+    src_len = max(tree.size() for tree, _ in pairs) + 2
+    toks = torch.zeros(len(pairs), src_len, dtype=torch.long)
+    expected = torch.full((len(pairs), src_len, src_len), tree_utils.HEAD_PAD_ID, dtype=torch.int)
+    for c, (tree, _) in enumerate(pairs):
+        size = tree.size()
+        tree_utils.flatten_mask_left(tree, 0, expected[c, :size, :size])
+        expected[c, size:, :] = tree_utils.HEAD_EXTRA_ID
+    expected = expected.to(tree_utils.ut.get_device())
+
+    # from linked trees, from ArrayTrees, and from the relation masks ArrayTrees store
+    assert torch.equal(tree_utils.get_enc_mask(toks, [tree for tree, _ in pairs]), expected)
+    array_trees = [array_tree for _, array_tree in pairs]
+    assert torch.equal(tree_utils.get_enc_mask(toks, array_trees), expected)
+    for array_tree in array_trees:
+        array_tree.set_relation_mask(array_tree.relation_mask())
+    assert torch.equal(tree_utils.get_enc_mask(toks, array_trees).int(), expected)
+
+
+def test_pos_embeddings_match_fold_down_tree(rng):
+    pairs = random_trees(rng, num_trees=30, max_nodes=20)
+    embed_dim = 6
+    torch.manual_seed(0)
+    root = torch.randn(embed_dim, dtype=torch.double)
+    mat_l = torch.randn(embed_dim, embed_dim, dtype=torch.double) / embed_dim ** 0.5
+    mat_r = torch.randn(embed_dim, embed_dim, dtype=torch.double) / embed_dim ** 0.5
+    def f(_, p, is_left): return (mat_l if is_left else mat_r) @ p
+
+    max_len = max(tree.size() for tree, _ in pairs) + 1
+    expected = torch.zeros(len(pairs), max_len, embed_dim, dtype=torch.double)
+    for c, (tree, array_tree) in enumerate(pairs):
+        expected[c, :tree.size()] = torch.stack(tree.fold_down_tree(f, root).flatten())
+        assert torch.allclose(torch.stack(list(array_tree.fold_down_tree(f, root).flatten())), expected[c, :tree.size()])
+
+    for share_paths in [True, False]:
+        structs = [array_tree for _, array_tree in pairs]
+        embeddings = tree_utils.get_pos_embeddings(structs, max_len, root, mat_l, mat_r, share_paths=share_paths)
+        assert torch.allclose(embeddings, expected)
+        # linked trees are converted with as_array_tree
+        embeddings = tree_utils.get_pos_embeddings([tree for tree, _ in pairs], max_len, root, mat_l, mat_r, share_paths=share_paths)
+        assert torch.allclose(embeddings, expected)
@@ -0,0 +1,36 @@
+import pytest
+import numpy
+import torch
+
+import nmt.utils as ut
+
+
+def test_pad_sequences_matches_loop():
+    rng = numpy.random.RandomState(0)
+    lengths = rng.randint(0, 9, size=17)
+    flat = rng.randint(1, 100, size=lengths.sum())
+    for width in [None, int(lengths.max()) + 3]:
+        padded = ut.pad_sequences(flat, lengths, pad_id=-1, width=width)
+        expected = numpy.full([len(lengths), width or lengths.max()], -1, dtype=numpy.int32)
+        start = 0
+        for i, length in enumerate(lengths):
+            expected[i, :length] = flat[start:start + length]
+            start += length
+        assert padded.dtype == numpy.int32
+        assert numpy.array_equal(padded, expected)
+
+
+def test_pad_sequences_empty():
+    assert ut.pad_sequences(numpy.zeros(0), [], pad_id=0).shape == (0, 0)
+    assert numpy.array_equal(ut.pad_sequences(numpy.zeros(0), [0, 0], pad_id=7, width=2), numpy.full([2, 2], 7))
+
+
+def test_group():
+    assert list(ut.group(iter(range(7)), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_sample_choice_temperature():
+    logprobs = torch.log_softmax(torch.randn(5, 11), dim=-1)
+    assert torch.equal(ut.sample_choice(top_k=3, temperature=0.)(logprobs), logprobs.argmax(dim=-1))
+    with pytest.raises(ValueError):
+        ut.sample_choice(temperature=-1.)